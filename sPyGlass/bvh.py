@@ -0,0 +1,422 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# A dynamic bounding volume hierarchy of axis aligned boxes, for the objects of large
+# scenes: frustum queries (eg. to fill a renderqueue.RenderQueue) and ray queries (eg.
+# picking with mathtools.unprojectRay).
+# Leaves keep a box enlarged by a margin, so objects moving a little don't change the
+# tree. Insertions pick the sibling with the smallest increase of surface area and
+# the tree is kept balanced with rotations (as Box2D's b2DynamicTree). The queries go
+# down the tree a level at a time, testing all the nodes of the level with numpy
+
+
+import numpy as N
+from culling import boxesInFrustum
+
+
+def _area(lo, hi):
+	d = hi - lo
+	return 2.0 * (d[0]*d[1] + d[1]*d[2] + d[2]*d[0])
+
+
+
+class BoundingVolumeTree(object):
+
+	class Error(ValueError):
+		pass
+
+
+	def __init__(self, margin=0.1, capacity=64):
+		self._margin = margin
+		self._root = -1
+		self._total_leaves = 0
+
+		self._lo = N.zeros((capacity, 3))
+		self._hi = N.zeros((capacity, 3))
+		self._parent = N.full(capacity, -1, dtype=N.int32)
+		self._child1 = N.full(capacity, -1, dtype=N.int32) # -1 for leaves
+		self._child2 = N.full(capacity, -1, dtype=N.int32)
+		self._height = N.full(capacity, -1, dtype=N.int32) # -1 for free nodes
+		self._stamps = N.zeros(capacity, dtype=N.int64) # see getStamp
+		self._last_stamp = 0
+		self._objects = [None] * capacity
+
+		self._free = range(capacity - 1, -1, -1)
+
+
+	def _allocNode(self):
+		if not self._free:
+			capacity = len(self._parent)
+			self._lo = N.concatenate([self._lo, N.zeros((capacity, 3))])
+			self._hi = N.concatenate([self._hi, N.zeros((capacity, 3))])
+			for name in ("_parent", "_child1", "_child2", "_height"):
+				setattr(self, name, N.concatenate([getattr(self, name), N.full(capacity, -1, dtype=N.int32)]))
+			self._stamps = N.concatenate([self._stamps, N.zeros(capacity, dtype=N.int64)])
+			self._objects += [None] * capacity
+			self._free = range(2 * capacity - 1, capacity - 1, -1)
+
+		node = self._free.pop()
+		self._parent[node] = self._child1[node] = self._child2[node] = -1
+		self._height[node] = 0
+		self._touch(node)
+		return node
+
+
+	def _freeNode(self, node):
+		self._height[node] = -1
+		self._objects[node] = None
+		self._touch(node)
+		self._free.append(node)
+
+
+	def _touch(self, node):
+		self._last_stamp += 1
+		self._stamps[node] = self._last_stamp
+
+
+	def __len__(self):
+		return self._total_leaves
+
+
+	# adds obj with bounds (lo, hi). Returns the proxy, the id of obj in the tree
+	def insert(self, obj, lo, hi):
+		leaf = self._allocNode()
+		self._lo[leaf] = N.asarray(lo, dtype=N.float64) - self._margin
+		self._hi[leaf] = N.asarray(hi, dtype=N.float64) + self._margin
+		self._objects[leaf] = obj
+		self._insertLeaf(leaf)
+		self._total_leaves += 1
+		return leaf
+
+
+	def remove(self, proxy):
+		if self._height[proxy] != 0:
+			raise self.Error("No such proxy: %s"%(proxy,))
+		self._removeLeaf(proxy)
+		self._freeNode(proxy)
+		self._total_leaves -= 1
+
+
+	# updates the bounds of a proxy. The tree only changes if they go out of the
+	# enlarged box of the leaf. Returns whether it changed
+	def move(self, proxy, lo, hi):
+		lo = N.asarray(lo, dtype=N.float64)
+		hi = N.asarray(hi, dtype=N.float64)
+
+		if (self._lo[proxy] <= lo).all() and (hi <= self._hi[proxy]).all():
+			return False
+
+		self._removeLeaf(proxy)
+		self._lo[proxy] = lo - self._margin
+		self._hi[proxy] = hi + self._margin
+		self._insertLeaf(proxy)
+		return True
+
+
+	def getObject(self, proxy):
+		return self._objects[proxy]
+
+
+	# the enlarged box of the proxy (or of any node)
+	def getBounds(self, proxy):
+		return self._lo[proxy].copy(), self._hi[proxy].copy()
+
+
+	# changes when the node is allocated or freed (node indices are reused) and, for
+	# the internal nodes, when the leaves under them change: state kept per node (eg.
+	# by occlusion.OcclusionCuller) is only valid for the stamp it was computed with.
+	# A leaf keeps its stamp when moved, while only its old and new ancestors change
+	def getStamp(self, node):
+		return self._stamps[node]
+
+
+	# the nodes, to walk the tree: the leaves are the proxies
+	def getRoot(self):
+		return self._root
+
+
+	def isLeaf(self, node):
+		return self._child1[node] == -1
+
+
+	def getChildren(self, node):
+		return self._child1[node], self._child2[node]
+
+
+	def getParent(self, node):
+		return self._parent[node]
+
+
+	def _insertLeaf(self, leaf):
+		if self._root == -1:
+			self._root = leaf
+			self._parent[leaf] = -1
+			return
+
+		lo, hi = self._lo, self._hi
+		c1s, c2s = self._child1, self._child2
+		leaf_lo, leaf_hi = lo[leaf], hi[leaf]
+
+		# find the best sibling
+		index = self._root
+		while c1s[index] != -1:
+			c1, c2 = c1s[index], c2s[index]
+
+			area = _area(lo[index], hi[index])
+			combined = _area(N.minimum(lo[index], leaf_lo), N.maximum(hi[index], leaf_hi))
+
+			# cost of making a new parent of this node and the leaf
+			cost = 2.0 * combined
+			# minimum cost of pushing the leaf further down
+			inheritance = 2.0 * (combined - area)
+
+			costs = []
+			for c in (c1, c2):
+				a = _area(N.minimum(lo[c], leaf_lo), N.maximum(hi[c], leaf_hi))
+				if c1s[c] != -1:
+					a -= _area(lo[c], hi[c])
+				costs.append(a + inheritance)
+
+			if cost < costs[0] and cost < costs[1]:
+				break
+
+			index = c1 if costs[0] < costs[1] else c2
+
+		sibling = index
+
+		old_parent = self._parent[sibling]
+		new_parent = self._allocNode()
+		lo, hi = self._lo, self._hi # the arrays may have grown
+		c1s, c2s = self._child1, self._child2
+
+		self._parent[new_parent] = old_parent
+		lo[new_parent] = N.minimum(lo[sibling], leaf_lo)
+		hi[new_parent] = N.maximum(hi[sibling], leaf_hi)
+		self._height[new_parent] = self._height[sibling] + 1
+
+		if old_parent != -1:
+			if c1s[old_parent] == sibling:
+				c1s[old_parent] = new_parent
+			else:
+				c2s[old_parent] = new_parent
+		else:
+			self._root = new_parent
+
+		c1s[new_parent] = sibling
+		c2s[new_parent] = leaf
+		self._parent[sibling] = new_parent
+		self._parent[leaf] = new_parent
+
+		self._refitUp(self._parent[leaf])
+
+
+	def _removeLeaf(self, leaf):
+		if leaf == self._root:
+			self._root = -1
+			return
+
+		parent = self._parent[leaf]
+		grand_parent = self._parent[parent]
+		sibling = self._child2[parent] if self._child1[parent] == leaf else self._child1[parent]
+
+		if grand_parent != -1:
+			if self._child1[grand_parent] == parent:
+				self._child1[grand_parent] = sibling
+			else:
+				self._child2[grand_parent] = sibling
+			self._parent[sibling] = grand_parent
+			self._freeNode(parent)
+
+			self._refitUp(grand_parent)
+		else:
+			self._root = sibling
+			self._parent[sibling] = -1
+			self._freeNode(parent)
+
+
+	# rebalances and refits the nodes from index up to the root
+	def _refitUp(self, index):
+		while index != -1:
+			index = self._balance(index)
+			self._touch(index)
+
+			c1, c2 = self._child1[index], self._child2[index]
+			self._height[index] = 1 + max(self._height[c1], self._height[c2])
+			self._lo[index] = N.minimum(self._lo[c1], self._lo[c2])
+			self._hi[index] = N.maximum(self._hi[c1], self._hi[c2])
+
+			index = self._parent[index]
+
+
+	# if a is imbalanced, rotates it left or right. Returns the new root of the subtree
+	def _balance(self, a):
+		c1s, c2s, parents, heights = self._child1, self._child2, self._parent, self._height
+
+		if c1s[a] == -1 or heights[a] < 2:
+			return a
+
+		b, c = c1s[a], c2s[a]
+		balance = heights[c] - heights[b]
+
+		if balance > 1:
+			return self._rotate(a, c, b, set_child1=False)
+		if balance < -1:
+			return self._rotate(a, b, c, set_child1=True)
+
+		return a
+
+
+	# moves up the child "up" of a, whose other child is "other". set_child1 tells
+	# whether "up" was the first child of a
+	def _rotate(self, a, up, other, set_child1):
+		c1s, c2s, parents, heights = self._child1, self._child2, self._parent, self._height
+		lo, hi = self._lo, self._hi
+
+		f, g = c1s[up], c2s[up]
+
+		# swap a and up
+		c1s[up] = a
+		parents[up] = parents[a]
+		parents[a] = up
+
+		if parents[up] != -1:
+			if c1s[parents[up]] == a:
+				c1s[parents[up]] = up
+			else:
+				c2s[parents[up]] = up
+		else:
+			self._root = up
+
+		# the highest grandchild stays under up, the other goes to a
+		if heights[f] > heights[g]:
+			keep, move = f, g
+		else:
+			keep, move = g, f
+
+		c2s[up] = keep
+		if set_child1:
+			c1s[a] = move
+		else:
+			c2s[a] = move
+		parents[move] = a
+
+		lo[a] = N.minimum(lo[other], lo[move])
+		hi[a] = N.maximum(hi[other], hi[move])
+		lo[up] = N.minimum(lo[a], lo[keep])
+		hi[up] = N.maximum(hi[a], hi[keep])
+
+		heights[a] = 1 + max(heights[other], heights[move])
+		heights[up] = 1 + max(heights[a], heights[keep])
+
+		self._touch(a)
+		self._touch(up)
+
+		return up
+
+
+	# goes down the tree a level at a time, keeping the nodes for which test(nodes)
+	# (an array of bools) is True. Returns the leaves found
+	def _query(self, test):
+		if self._root == -1:
+			return N.zeros(0, dtype=N.int32)
+
+		leaves = []
+		nodes = N.array([self._root], dtype=N.int32)
+		while nodes.size:
+			nodes = nodes[test(nodes)]
+			is_leaf = self._child1[nodes] == -1
+			leaves.append(nodes[is_leaf])
+			inner = nodes[~is_leaf]
+			nodes = N.concatenate([self._child1[inner], self._child2[inner]])
+
+		return N.concatenate(leaves)
+
+
+	# the objects whose boxes overlap (lo, hi)
+	def queryBox(self, lo, hi):
+		lo = N.asarray(lo, dtype=N.float64)
+		hi = N.asarray(hi, dtype=N.float64)
+
+		def test(nodes):
+			return ((self._lo[nodes] <= hi) & (self._hi[nodes] >= lo)).all(axis=1)
+
+		return [self._objects[i] for i in self._query(test)]
+
+
+	# the objects whose boxes are at least partly inside the frustum, with the planes
+	# of culling.frustumPlanes (eg. of projection*view, for world space boxes)
+	def queryFrustum(self, planes):
+		def test(nodes):
+			return boxesInFrustum(planes, self._lo[nodes], self._hi[nodes])
+
+		return [self._objects[i] for i in self._query(test)]
+
+
+	# the objects whose boxes are hit by the ray, as (distance, object) sorted by
+	# distance. The distance is where the ray enters the box (0 if it starts inside), in
+	# units of the length of direction
+	def queryRay(self, origin, direction, max_distance=N.inf):
+		origin = N.asarray(origin, dtype=N.float64)
+		direction = N.asarray(direction, dtype=N.float64)
+
+		# no zero components, so the slabs parallel to the ray don't give NaNs
+		d = N.where(N.abs(direction) < 1e-30, N.where(direction < 0.0, -1e-30, 1e-30), direction)
+		inv_d = 1.0 / d
+
+		def entries(nodes):
+			t1 = (self._lo[nodes] - origin) * inv_d
+			t2 = (self._hi[nodes] - origin) * inv_d
+			t_in = N.maximum(N.minimum(t1, t2).max(axis=1), 0.0)
+			t_out = N.maximum(t1, t2).min(axis=1)
+			return t_in, t_out
+
+		def test(nodes):
+			t_in, t_out = entries(nodes)
+			return (t_in <= t_out) & (t_in <= max_distance)
+
+		leaves = self._query(test)
+		t_in = entries(leaves)[0]
+		order = N.argsort(t_in, kind="mergesort")
+
+		return [(t_in[i], self._objects[leaves[i]]) for i in order]
+
+
+	# the first object hit by the ray, as (distance, object), or None. If given,
+	# hit(obj, origin, direction) does the exact test, returning the distance or None
+	def pick(self, origin, direction, max_distance=N.inf, hit=None):
+		best = None
+		for t, obj in self.queryRay(origin, direction, max_distance):
+			if best is not None and t > best[0]:
+				break # the rest of the boxes are further away
+
+			if hit is not None:
+				t = hit(obj, origin, direction)
+				if t is None or t > max_distance:
+					continue
+
+			if best is None or t < best[0]:
+				best = (t, obj)
+
+		return best
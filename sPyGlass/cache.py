@@ -0,0 +1,166 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import weakref
+from collections import namedtuple, OrderedDict
+
+
+# all the caches, to invalidate the entries of an object in each of them
+_caches = weakref.WeakSet()
+
+
+# removes the entries of obj (eg. a DataVbo whose fields have been redefined) from
+# every cache
+def invalidateAll(obj):
+	for cache in list(_caches):
+		cache.invalidate(obj)
+
+
+
+# A LRU cache of GL objects built from other objects (eg. the VAO for a shader and a
+# DataVbo). The objects of a key are only weakly referenced: their entries go away
+# with them, and ids reused by new objects never hit old entries.
+class ObjectCache(object):
+
+	Stats = namedtuple("Stats",[
+				"size",
+				"max_size",
+				"hits",
+				"misses",
+				"evictions",
+			])
+
+
+	def __init__(self, max_size=256):
+		self._max_size = max_size
+		self._entries = OrderedDict() # key -> (weakrefs of the objects, value), oldest first
+		self._keys_by_id = {} # id(object) -> set of keys
+
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+
+		_caches.add(self)
+
+
+	# returns the value cached for the objects (and extra, hashable, key values),
+	# calling factory() to create it if it's missing
+	def get(self, objects, factory, extra=()):
+		key = tuple(id(o) for o in objects) + tuple(extra)
+
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			refs, value = entry
+			if all(r() is o for r, o in zip(refs, objects)):
+				self._entries[key] = entry # now the most recently used
+				self._hits += 1
+				return value
+
+			self._forgetKey(key, refs)
+
+		self._misses += 1
+
+		value = factory()
+		self._add(key, objects, value)
+
+		return value
+
+
+	def _add(self, key, objects, value):
+		self_ref = weakref.ref(self)
+
+		def died(ref):
+			cache = self_ref()
+			if cache is not None:
+				cache._invalidateId(ref.obj_id)
+
+		refs = []
+		for o in objects:
+			r = _IdRef(o, died)
+			r.obj_id = id(o)
+			refs.append(r)
+			self._keys_by_id.setdefault(id(o), set()).add(key)
+
+		self._entries[key] = (refs, value)
+		self._evict()
+
+
+	# drops the least recently used entries over max_size
+	def _evict(self):
+		while len(self._entries) > self._max_size:
+			old_key, (old_refs, old_value) = self._entries.popitem(last=False)
+			self._forgetKey(old_key, old_refs)
+			self._evictions += 1
+
+
+	def _forgetKey(self, key, refs):
+		for r in refs:
+			keys = self._keys_by_id.get(r.obj_id)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self._keys_by_id[r.obj_id]
+
+
+	def _invalidateId(self, obj_id):
+		for key in self._keys_by_id.pop(obj_id, ()):
+			entry = self._entries.pop(key, None)
+			if entry is not None:
+				self._forgetKey(key, entry[0])
+
+
+	# removes every entry built from obj
+	def invalidate(self, obj):
+		self._invalidateId(id(obj))
+
+
+	def clear(self):
+		self._entries.clear()
+		self._keys_by_id.clear()
+
+
+	def setMaxSize(self, max_size):
+		self._max_size = max_size
+		self._evict()
+
+
+	def stats(self):
+		return self.Stats(
+				size = len(self._entries),
+				max_size = self._max_size,
+				hits = self._hits,
+				misses = self._misses,
+				evictions = self._evictions,
+			)
+
+
+	def __len__(self):
+		return len(self._entries)
+
+
+
+# a weak reference that can hold the id of its object after it dies
+class _IdRef(weakref.ref):
+	__slots__ = ("obj_id",)
@@ -0,0 +1,101 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# View frustum culling: the planes of the frustum are taken from a projection matrix
+# (times the view and model matrices, to get them in world or object space), and bounds
+# are tested against them many at once
+
+
+import numpy as N
+
+
+# the 6 planes (a, b, c, d) of the frustum of m (eg. projection*modelview, column
+# vectors), as a (6, 4) array with normalized normals pointing inside: a point p is
+# inside if a*x + b*y + c*z + d >= 0 for all of them (Gribb & Hartmann)
+def frustumPlanes(m):
+	m = N.asarray(m, dtype=N.float64)
+	planes = N.array([
+			m[3] + m[0], # left
+			m[3] - m[0], # right
+			m[3] + m[1], # bottom
+			m[3] - m[1], # top
+			m[3] + m[2], # near
+			m[3] - m[2], # far
+		])
+	norms = N.sqrt((planes[:,:3] ** 2).sum(axis=1))
+	return planes / N.where(norms > 0.0, norms, 1.0)[:,None]
+
+
+# pads 2d (or 1d) points to 3d, with z=0
+def _points3(p):
+	p = N.asarray(p, dtype=N.float64)
+	if p.shape[-1] >= 3:
+		return p[...,:3]
+	return N.concatenate([p, N.zeros(p.shape[:-1] + (3 - p.shape[-1],))], axis=-1)
+
+
+# bool array: whether each sphere is at least partly inside the frustum
+def spheresInFrustum(planes, centers, radii):
+	d = N.dot(_points3(N.atleast_2d(centers)), planes[:,:3].T) + planes[:,3]
+	return (d >= -N.asarray(radii, dtype=N.float64).reshape(-1, 1)).all(axis=1)
+
+
+# bool array: whether each box (min corner, max corner) is at least partly inside the
+# frustum. Tests the corner furthest along each plane normal
+def boxesInFrustum(planes, mins, maxs):
+	mins = _points3(N.atleast_2d(mins))
+	maxs = _points3(N.atleast_2d(maxs))
+	positive = planes[:,:3] >= 0.0 # (6, 3)
+
+	# (boxes, planes, 3)
+	corners = N.where(positive[None,:,:], maxs[:,None,:], mins[:,None,:])
+	d = (corners * planes[None,:,:3]).sum(axis=2) + planes[:,3]
+	return (d >= 0.0).all(axis=1)
+
+
+# the spheres (center, radius) in the space of each of the (n, 4, 4) matrices: returns
+# (centers, radii). The radii are scaled by the largest scale of each matrix. center
+# and radius can also be (n, 3) and (n,) arrays, a sphere per matrix
+def transformSpheres(matrices, center, radius):
+	matrices = N.asarray(matrices, dtype=N.float64)
+	c = _points3(center)
+	if c.ndim == 1:
+		centers = N.einsum("nij,j->ni", matrices[:,:3,:3], c) + matrices[:,:3,3]
+	else:
+		centers = N.einsum("nij,nj->ni", matrices[:,:3,:3], c) + matrices[:,:3,3]
+	scales = N.sqrt((matrices[:,:3,:3] ** 2).sum(axis=1)).max(axis=1)
+	return centers, N.asarray(radius, dtype=N.float64) * scales
+
+
+# the axis aligned boxes around the (n) boxes (min corner, max corner) transformed by
+# each of the (n, 4, 4) matrices: returns (mins, maxs)
+def transformBoxes(matrices, mins, maxs):
+	matrices = N.asarray(matrices, dtype=N.float64)
+	mins = _points3(N.atleast_2d(mins))
+	maxs = _points3(N.atleast_2d(maxs))
+
+	centers = N.einsum("nij,nj->ni", matrices[:,:3,:3], (mins + maxs) * 0.5) + matrices[:,:3,3]
+	extents = N.einsum("nij,nj->ni", N.abs(matrices[:,:3,:3]), (maxs - mins) * 0.5)
+	return centers - extents, centers + extents
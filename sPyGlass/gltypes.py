@@ -195,7 +195,7 @@ class MinimalNumberType:
                     bits = 32
         elif self._max_val >= 256:
             bits = 16
-            if self._min_val >= 4294967296:
+            if self._max_val >= 65536:
                 bits = 32
         if signed:
             self._type = NumberType('int %s' % bits)
@@ -210,7 +210,7 @@ class MinimalNumberType:
             return True
         if isinstance(d, int):
             self._min_val = min(self._min_val, d)
-            self._max_val = min(self._max_val, d)
+            self._max_val = max(self._max_val, d)
             return False
         if isinstance(d, list) or isinstance(d, tuple):
             r = False
@@ -233,7 +233,7 @@ class MinimalNumberType:
             return True
         if len(s) == 0:
             self._min_val = min(self._min_val, d)
-            self._max_val = min(self._max_val, d)
+            self._max_val = max(self._max_val, d)
             return False
         for v in d:
             r = self._test(v)
@@ -242,3 +242,36 @@ class MinimalNumberType:
 
         if r:
             return True
+
+
+# Types of the vertex attributes (the fields of a DataVbo) by name. The packed types
+# hold the 4 components of the attribute in a single 32 bit item
+_attrib_type_t = namedtuple('_attrib_type_t', ['numpy_type', 'gl_type', 'packed'])
+
+AttribTypes = {'float32': _attrib_type_t('f4', GL_FLOAT, False),
+ 'float64': _attrib_type_t('f8', GL_DOUBLE, False),
+ 'float16': _attrib_type_t('f2', GL_HALF_FLOAT, False),
+ 'int8': _attrib_type_t('i1', GL_BYTE, False),
+ 'uint8': _attrib_type_t('u1', GL_UNSIGNED_BYTE, False),
+ 'int16': _attrib_type_t('i2', GL_SHORT, False),
+ 'uint16': _attrib_type_t('u2', GL_UNSIGNED_SHORT, False),
+ 'int32': _attrib_type_t('i4', GL_INT, False),
+ 'uint32': _attrib_type_t('u4', GL_UNSIGNED_INT, False),
+ 'int_2_10_10_10': _attrib_type_t('i4', GL_INT_2_10_10_10_REV, True),
+ 'uint_2_10_10_10': _attrib_type_t('u4', GL_UNSIGNED_INT_2_10_10_10_REV, True)}
+
+def attribTypeName(dtype):
+    dtype = N.dtype(dtype)
+    for name, t in AttribTypes.items():
+        if not t.packed and N.dtype(t.numpy_type) == dtype:
+            return name
+
+    return None
+
+
+# bytes taken by an attribute of size components
+def attribBytes(size, type_name):
+    t = AttribTypes[type_name]
+    if t.packed:
+        return 4
+    return size * N.dtype(t.numpy_type).itemsize
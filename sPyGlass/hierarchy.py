@@ -0,0 +1,291 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import numpy as N
+from collections import namedtuple
+from culling import transformBoxes
+
+
+# what ObjManager.drawMany takes
+Instance = namedtuple("Instance",[
+			"transform",
+			"binders",
+		])
+
+
+# rotation matrices of an array of quaternions (w, x, y, z, as in libs.transformations)
+def quaternionMatrices(q):
+	q = N.asarray(q, dtype=N.float64)
+	n = (q * q).sum(axis=1)
+	s = N.where(n > 0.0, 2.0 / N.where(n > 0.0, n, 1.0), 0.0)
+
+	w, x, y, z = q.T
+	R = N.empty((len(q), 3, 3))
+	R[:,0,0] = 1.0 - s * (y*y + z*z)
+	R[:,0,1] = s * (x*y - w*z)
+	R[:,0,2] = s * (x*z + w*y)
+	R[:,1,0] = s * (x*y + w*z)
+	R[:,1,1] = 1.0 - s * (x*x + z*z)
+	R[:,1,2] = s * (y*z - w*x)
+	R[:,2,0] = s * (x*z - w*y)
+	R[:,2,1] = s * (y*z + w*x)
+	R[:,2,2] = 1.0 - s * (x*x + y*y)
+	return R
+
+
+
+# A hierarchy of transforms, kept as arrays (structure of arrays): each node has a
+# parent (or -1), and a local translation, rotation (quaternion) and scale. The world
+# matrices (parent's world matrix times the local one) are computed with a numpy
+# pass per level of the hierarchy, only for the nodes changed since the last update
+# and their descendants.
+# Parents are always added before their children.
+# Objects attached to nodes can be kept in a bvh.BoundingVolumeTree (see addToTree),
+# their world space boxes being moved in the tree by update()
+class TransformHierarchy(object):
+
+	class Error(ValueError):
+		pass
+
+
+	def __init__(self, capacity=64):
+		self._total = 0
+		self._levels = None # node indices of each depth, built on demand
+
+		self._parents = N.zeros(capacity, dtype=N.int32)
+		self._depths = N.zeros(capacity, dtype=N.int32)
+		self._translations = N.zeros((capacity, 3))
+		self._rotations = N.zeros((capacity, 4))
+		self._scales = N.ones((capacity, 3))
+		self._dirty = N.zeros(capacity, dtype=bool)
+
+		self._local = N.zeros((capacity, 4, 4))
+		self._world = N.zeros((capacity, 4, 4))
+
+		# the objects in trees: (tree, proxy), node and local bounds of each
+		self._tree_proxies = []
+		self._tree_nodes = []
+		self._tree_bounds = []
+		self._tree_arrays = None # (nodes, mins, maxs), built on demand
+
+
+	def _grow(self):
+		capacity = len(self._parents) * 2
+		for name in ("_parents", "_depths", "_translations", "_rotations", "_scales", "_dirty", "_local", "_world"):
+			old = getattr(self, name)
+			new = N.ones((capacity,) + old.shape[1:], dtype=old.dtype) if name == "_scales" else N.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+			new[:len(old)] = old
+			setattr(self, name, new)
+
+
+	# returns the index of the new node
+	def add(self, parent=-1, translation=(0.0, 0.0, 0.0), rotation=(1.0, 0.0, 0.0, 0.0), scale=(1.0, 1.0, 1.0)):
+		if parent >= self._total:
+			raise self.Error("No node %s to be the parent"%(parent,))
+
+		if self._total == len(self._parents):
+			self._grow()
+
+		i = self._total
+		self._total += 1
+
+		self._parents[i] = parent
+		self._depths[i] = self._depths[parent] + 1 if parent >= 0 else 0
+		self._translations[i] = translation
+		self._rotations[i] = rotation
+		self._scales[i] = scale
+		self._dirty[i] = True
+		self._levels = None
+
+		return i
+
+
+	def __len__(self):
+		return self._total
+
+
+	def getParent(self, node):
+		return int(self._parents[node])
+
+
+	# sets any of the local translation, rotation and scale of node (or of an array of
+	# nodes, with arrays of values)
+	def setLocal(self, node, translation=None, rotation=None, scale=None):
+		if translation is not None:
+			self._translations[node] = translation
+		if rotation is not None:
+			self._rotations[node] = rotation
+		if scale is not None:
+			self._scales[node] = scale
+		self._dirty[node] = True
+
+
+	# the arrays of the local values of all the nodes, to be changed in place (followed
+	# by markDirty)
+	def getTranslations(self):
+		return self._translations[:self._total]
+
+
+	def getRotations(self):
+		return self._rotations[:self._total]
+
+
+	def getScales(self):
+		return self._scales[:self._total]
+
+
+	def markDirty(self, nodes=None):
+		if nodes is None:
+			self._dirty[:self._total] = True
+		else:
+			self._dirty[nodes] = True
+
+
+	def _getLevels(self):
+		if self._levels is None:
+			depths = self._depths[:self._total]
+			self._levels = [N.flatnonzero(depths == d) for d in xrange(int(depths.max()) + 1 if self._total else 0)]
+		return self._levels
+
+
+	# adds obj to a bvh.BoundingVolumeTree with the bounds (lo, hi) in the space of node
+	# (by default, those of obj.getBoundingBox(), eg. an ObjManager), transformed to
+	# world space. The proxy is moved in the tree when the node changes. Returns it
+	def addToTree(self, tree, node, obj, lo=None, hi=None):
+		if node >= self._total:
+			raise self.Error("No node %s"%(node,))
+
+		if lo is None:
+			lo, hi = obj.getBoundingBox()
+
+		# 2d bounds are at z=0
+		bounds = N.zeros((2, 3))
+		bounds[0,:min(len(lo), 3)] = N.asarray(lo)[:3]
+		bounds[1,:min(len(hi), 3)] = N.asarray(hi)[:3]
+
+		world_lo, world_hi = transformBoxes(self.getWorldMatrices()[[node]], bounds[:1], bounds[1:])
+		proxy = tree.insert(obj, world_lo[0], world_hi[0])
+
+		self._tree_proxies.append((tree, proxy))
+		self._tree_nodes.append(node)
+		self._tree_bounds.append(bounds)
+		self._tree_arrays = None
+
+		return proxy
+
+
+	def removeFromTree(self, tree, proxy):
+		i = self._tree_proxies.index((tree, proxy))
+		del self._tree_proxies[i]
+		del self._tree_nodes[i]
+		del self._tree_bounds[i]
+		self._tree_arrays = None
+
+		tree.remove(proxy)
+
+
+	# moves the objects in trees attached to the changed nodes (a bool array)
+	def _moveInTrees(self, changed):
+		if not self._tree_proxies:
+			return
+
+		if self._tree_arrays is None:
+			bounds = N.array(self._tree_bounds)
+			self._tree_arrays = (N.array(self._tree_nodes, dtype=N.intp), bounds[:,0], bounds[:,1])
+
+		nodes, mins, maxs = self._tree_arrays
+
+		moved = N.flatnonzero(changed[nodes])
+		if not moved.size:
+			return
+
+		los, his = transformBoxes(self._world[nodes[moved]], mins[moved], maxs[moved])
+		for i, lo, hi in zip(moved, los, his):
+			tree, proxy = self._tree_proxies[i]
+			tree.move(proxy, lo, hi)
+
+
+	# computes the world matrices of the changed nodes and their descendants, and moves
+	# their objects in trees
+	def update(self):
+		if not self._dirty[:self._total].any():
+			return
+
+		levels = self._getLevels()
+		dirty = self._dirty
+		parents = self._parents
+
+		# the children of changed nodes change too
+		for nodes in levels[1:]:
+			dirty[nodes] |= dirty[parents[nodes]]
+
+		changed = N.flatnonzero(dirty[:self._total])
+
+		local = self._local
+		local[changed] = 0.0
+		local[changed,:3,:3] = quaternionMatrices(self._rotations[changed]) * self._scales[changed][:,None,:]
+		local[changed,:3,3] = self._translations[changed]
+		local[changed,3,3] = 1.0
+
+		world = self._world
+		for d, nodes in enumerate(levels):
+			nodes = nodes[dirty[nodes]]
+			if not nodes.size:
+				continue
+			if d == 0:
+				world[nodes] = local[nodes]
+			else:
+				world[nodes] = N.einsum("nij,njk->nik", world[parents[nodes]], local[nodes])
+
+		self._moveInTrees(dirty)
+
+		dirty[:self._total] = False
+
+
+	# (nodes, 4, 4) array of world matrices, updated. Indexed by node. It's a view of
+	# the hierarchy's own array, only valid until the next change of the nodes
+	def getWorldMatrices(self):
+		self.update()
+		return self._world[:self._total]
+
+
+	# a copy, so it doesn't change with the node
+	def getWorldMatrix(self, node):
+		self.update()
+		return self._world[node].copy()
+
+
+	# the view matrix times the world matrix of the nodes (all by default)
+	def getModelViewMatrices(self, view_m, nodes=None):
+		world = self.getWorldMatrices()
+		if nodes is not None:
+			world = world[nodes]
+		return N.einsum("ij,njk->nik", view_m, world)
+
+
+	# Instances for ObjManager.drawMany, with copies of the world matrices of the nodes
+	def getInstances(self, nodes, binders=None):
+		world = self.getWorldMatrices()[N.asarray(nodes, dtype=N.intp)]
+		return [Instance(m, binders) for m in world]
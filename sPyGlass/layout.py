@@ -0,0 +1,239 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Vertex layouts with a type per field, to store the vertex data in less memory
+# (eg. normals as normalized int16 or packed 2_10_10_10, texture coordinates as half
+# floats), and the conversion between separate arrays of floats per field and the
+# interleaved records of such a layout
+
+import numpy as N
+from collections import namedtuple
+from glcompat import *
+from gltypes import AttribTypes, attribBytes
+from vbo import DataVbo
+
+
+Field = namedtuple("Field",[
+			"name",
+			"size", # components
+			"type", # one of gltypes.AttribTypes
+			"normalized",
+			"offset", # in bytes
+		])
+
+
+class VertexLayout(object):
+	class Error(ValueError):
+		pass
+
+	# fields are tuples like: (name, size[, type[, normalized]]), type defaulting to
+	# "float32". eg. VertexLayout(("position",3),("normal",3,"int_2_10_10_10",True),("tc",2,"float16"))
+	# Fields are aligned to 4 bytes, as is the record size
+	def __init__(self, *fields):
+		self._fields = []
+
+		offset = 0
+		for f in fields:
+			name, size = f[0], f[1]
+			f_type = f[2] if len(f) > 2 else "float32"
+			normalized = bool(f[3]) if len(f) > 3 else False
+
+			if f_type not in AttribTypes:
+				raise self.Error("Type %s of field '%s' is not one of: %s"%(f_type, name, AttribTypes.keys()))
+
+			if size < 1 or size > 4:
+				raise self.Error("Field size %s for field '%s' is not in the range [1..4]"%(size, name))
+
+			self._fields.append(Field(name, size, f_type, normalized, offset))
+
+			offset = _align4(offset + attribBytes(size, f_type))
+
+		self._record_bytes = offset
+
+		self._dtype = N.dtype({
+				"names": [f.name for f in self._fields],
+				"formats": [self._fieldFormat(f) for f in self._fields],
+				"offsets": [f.offset for f in self._fields],
+				"itemsize": self._record_bytes,
+			})
+
+
+	def _fieldFormat(self, f):
+		t = AttribTypes[f.type]
+		if t.packed or f.size == 1:
+			return t.numpy_type
+		return (t.numpy_type, (f.size,))
+
+
+	def getFields(self):
+		return list(self._fields)
+
+
+	def getRecordBytes(self):
+		return self._record_bytes
+
+
+	# the numpy dtype of a record
+	def getDtype(self):
+		return self._dtype
+
+
+	# builds the records from arrays, a dictionary of field name -> array of values
+	# (one row per vertex). Values are converted to the type of each field
+	def interleave(self, arrays):
+		total = None
+		for f in self._fields:
+			try:
+				a = arrays[f.name]
+			except KeyError:
+				raise self.Error("No values for field '%s'"%f.name)
+
+			if total is None:
+				total = len(a)
+			elif len(a) != total:
+				raise self.Error("Field '%s' has %s values, %s expected"%(f.name, len(a), total))
+
+		records = N.zeros(total or 0, dtype=self._dtype)
+
+		for f in self._fields:
+			a = N.asarray(arrays[f.name], dtype="f8").reshape(total, -1)
+			records[f.name] = _encode(f, a).reshape(records[f.name].shape)
+
+		return records
+
+
+	# the inverse of interleave: returns a dictionary of field name -> float32 values
+	def deinterleave(self, records):
+		arrays = {}
+		for f in self._fields:
+			arrays[f.name] = _decode(f, records[f.name].reshape(len(records), -1)).astype("f4")
+
+		return arrays
+
+
+	def createDataVbo(self, arrays, usage = GL_STATIC_DRAW, stream=None, ring_size=3):
+		data_vbo = DataVbo(self.interleave(arrays), usage, stream, ring_size)
+		data_vbo.defineFields(*[(f.name, f.size, f.type, f.normalized) for f in self._fields])
+		return data_vbo
+
+
+
+# converts a DataVbo to a layout, the fields of both are matched by name
+def convertDataVbo(data_vbo, layout, usage = GL_STATIC_DRAW):
+	arrays = {}
+	for f_name, f_size, f_type, normalized, f_offset in data_vbo.getFields():
+		src = Field(f_name, f_size, f_type, normalized, f_offset)
+		arrays[f_name] = _decode(src, data_vbo.getSlice(f_name))
+
+	return layout.createDataVbo(arrays, usage)
+
+
+
+def _align4(offset):
+	return (offset + 3) & ~3
+
+
+def _intRange(np_type):
+	info = N.iinfo(np_type)
+	return info.min, info.max
+
+
+# converts float values (rows of a field) to the stored representation
+def _encode(f, a):
+	t = AttribTypes[f.type]
+
+	if t.packed:
+		return _pack_2_10_10_10(a, f.type == "int_2_10_10_10", f.normalized).astype(t.numpy_type)
+
+	if N.dtype(t.numpy_type).kind == "f":
+		return a.astype(t.numpy_type)
+
+	lo, hi = _intRange(t.numpy_type)
+	if f.normalized:
+		a = N.clip(a, -1.0 if lo else 0.0, 1.0) * hi
+
+	return N.clip(N.round(a), lo, hi).astype(t.numpy_type)
+
+
+def _decode(f, v):
+	t = AttribTypes[f.type]
+
+	if t.packed:
+		return _unpack_2_10_10_10(v.reshape(-1), f.type == "int_2_10_10_10", f.normalized)[:,:f.size]
+
+	a = v.astype("f8")
+
+	if f.normalized and N.dtype(t.numpy_type).kind != "f":
+		lo, hi = _intRange(t.numpy_type)
+		a = N.maximum(a / hi, -1.0)
+
+	return a
+
+
+# x, y and z take 10 bits each, w the upper 2 (the GL_*_2_10_10_10_REV order)
+_packed_bits = (10, 10, 10, 2)
+
+def _pack_2_10_10_10(a, signed, normalized):
+	a = N.hstack([a, N.zeros((len(a), 4 - a.shape[1]))]) if a.shape[1] < 4 else a
+
+	packed = N.zeros(len(a), dtype="i8")
+	shift = 0
+	for i, bits in enumerate(_packed_bits):
+		if signed:
+			lo, hi = -(1 << (bits-1)), (1 << (bits-1)) - 1
+		else:
+			lo, hi = 0, (1 << bits) - 1
+
+		c = a[:,i]
+		if normalized:
+			c = N.clip(c, -1.0 if signed else 0.0, 1.0) * hi
+
+		c = N.clip(N.round(c), lo, hi).astype("i8")
+		packed |= (c & ((1 << bits) - 1)) << shift
+		shift += bits
+
+	if signed: # the stored item is an int32
+		packed = N.where(packed >= 1 << 31, packed - (1 << 32), packed)
+
+	return packed
+
+
+def _unpack_2_10_10_10(v, signed, normalized):
+	v = v.astype("i8") & 0xffffffff
+
+	a = N.zeros((len(v), 4))
+	shift = 0
+	for i, bits in enumerate(_packed_bits):
+		c = (v >> shift) & ((1 << bits) - 1)
+		if signed:
+			c = N.where(c >= 1 << (bits-1), c - (1 << bits), c)
+			hi = (1 << (bits-1)) - 1
+		else:
+			hi = (1 << bits) - 1
+
+		a[:,i] = N.maximum(c / float(hi), -1.0) if normalized else c
+		shift += bits
+
+	return a
@@ -0,0 +1,229 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Mesh simplification for levels of detail. Triangles are removed by collapsing
+# edges into one of their vertices (half edge collapses), picking first the ones with
+# the smallest quadric error (Garland & Heckbert 1997). Since no vertices are
+# created, the simplified levels are just other index ranges over the same vertex
+# data, and can be appended to the mesh's index buffer
+
+import heapq
+import numpy as N
+from collections import namedtuple
+
+
+# a level of a LOD chain, as stored in an IndexVbo by buildLodChain
+LodLevel = namedtuple("LodLevel",[
+			"first_index",
+			"total_primitives", # triangles
+			"error", # approximate distance from the original surface
+		])
+
+
+# quadrics of the boundary edges are weighted so borders are kept
+_boundary_weight = 1000.0
+
+
+class _Simplifier(object):
+	def __init__(self, positions, indices):
+		P = self._P = N.asarray(positions, dtype="f8").reshape(len(positions), -1)[:,:3]
+		tris = N.asarray(indices).reshape(-1, 3).astype("i8")
+
+		# degenerate triangles are dropped
+		tris = tris[(tris[:,0] != tris[:,1]) & (tris[:,1] != tris[:,2]) & (tris[:,0] != tris[:,2])]
+
+		total_vertices = len(P)
+		Q = N.zeros((total_vertices, 4, 4))
+
+		p0, p1, p2 = P[tris[:,0]], P[tris[:,1]], P[tris[:,2]]
+		n = N.cross(p1 - p0, p2 - p0)
+		area = N.sqrt((n * n).sum(axis=1))
+		n /= N.maximum(area, 1e-30)[:,None]
+
+		# the plane of each triangle, weighted by its area
+		planes = N.hstack([n, -(n * p0).sum(axis=1)[:,None]])
+		K = planes[:,:,None] * planes[:,None,:] * area[:,None,None]
+		for k in xrange(3):
+			N.add.at(Q, tris[:,k], K)
+
+		# edges used by a single triangle are on the boundary: a plane through them,
+		# perpendicular to the triangle, keeps them in place
+		edges = N.vstack([tris[:,[0,1]], tris[:,[1,2]], tris[:,[2,0]]])
+		normals = N.vstack([n, n, n])
+		keys = N.sort(edges, axis=1)
+		keys = keys[:,0] * total_vertices + keys[:,1]
+		uniq, inverse, counts = N.unique(keys, return_inverse=True, return_counts=True)
+		boundary = counts[inverse] == 1
+
+		if boundary.any():
+			a, b = P[edges[boundary,0]], P[edges[boundary,1]]
+			e = b - a
+			m = N.cross(e, normals[boundary])
+			m /= N.maximum(N.sqrt((m * m).sum(axis=1)), 1e-30)[:,None]
+			bplanes = N.hstack([m, -(m * a).sum(axis=1)[:,None]])
+			K = bplanes[:,:,None] * bplanes[:,None,:] * ((e * e).sum(axis=1) * _boundary_weight)[:,None,None]
+			N.add.at(Q, edges[boundary,0], K)
+			N.add.at(Q, edges[boundary,1], K)
+
+		self._Q = Q
+		self._H = N.hstack([P, N.ones((total_vertices, 1))]) # homogeneous positions
+
+		self._tris = tris.tolist()
+		self._alive = [True] * len(self._tris)
+		self._total_alive = len(self._tris)
+
+		self._vtris = [set() for i in xrange(total_vertices)]
+		for t, tri in enumerate(self._tris):
+			for v in tri:
+				self._vtris[v].add(t)
+
+		self._version = [0] * total_vertices
+		self._heap = []
+		self._error = 0.0
+
+		for key in uniq.tolist():
+			self._pushEdge(key // total_vertices, key % total_vertices)
+
+
+	def _neighbours(self, v):
+		s = set()
+		for t in self._vtris[v]:
+			s.update(self._tris[t])
+		s.discard(v)
+		return s
+
+
+	# pushes the cheapest direction of the collapse of edge (a, b)
+	def _pushEdge(self, a, b):
+		H = self._H
+		q = self._Q[a] + self._Q[b]
+		cost_a = H[a].dot(q).dot(H[a]) # b collapses into a
+		cost_b = H[b].dot(q).dot(H[b])
+
+		if cost_a < cost_b:
+			heapq.heappush(self._heap, (cost_a, b, a, self._version[b], self._version[a]))
+		else:
+			heapq.heappush(self._heap, (cost_b, a, b, self._version[a], self._version[b]))
+
+
+	def _normal(self, tri, moved, to):
+		p = [self._P[to] if v == moved else self._P[v] for v in tri]
+		return N.cross(p[1] - p[0], p[2] - p[0])
+
+
+	# whether u can collapse into v without folding triangles over or making the
+	# mesh non manifold
+	def _canCollapse(self, u, v):
+		shared = [t for t in self._vtris[u] if v in self._tris[t]]
+		if not shared:
+			return False
+
+		if len(self._neighbours(u) & self._neighbours(v)) != len(shared):
+			return False
+
+		for t in self._vtris[u]:
+			tri = self._tris[t]
+			if v in tri:
+				continue
+			if self._normal(tri, u, u).dot(self._normal(tri, u, v)) <= 0.0:
+				return False
+
+		return True
+
+
+	def _collapse(self, u, v):
+		for t in list(self._vtris[u]):
+			tri = self._tris[t]
+			if v in tri:
+				self._alive[t] = False
+				self._total_alive -= 1
+				for w in tri:
+					self._vtris[w].discard(t)
+			else:
+				tri[tri.index(u)] = v
+				self._vtris[v].add(t)
+
+		self._vtris[u] = set()
+		self._Q[v] += self._Q[u]
+		self._version[u] += 1
+		self._version[v] += 1
+
+		for w in self._neighbours(v):
+			self._pushEdge(v, w)
+
+
+	def _snapshot(self):
+		return N.array([tri for t, tri in enumerate(self._tris) if self._alive[t]], dtype="u4").reshape(-1)
+
+
+	# simplifies down to each number of triangles in targets (in decreasing order)
+	# returns a list of (indices, error)
+	def run(self, targets):
+		results = []
+		heap = self._heap
+
+		for target in targets:
+			while self._total_alive > target and heap:
+				cost, u, v, ver_u, ver_v = heapq.heappop(heap)
+
+				if ver_u != self._version[u] or ver_v != self._version[v]:
+					continue # stale
+
+				if not self._canCollapse(u, v):
+					continue
+
+				self._error = max(self._error, cost)
+				self._collapse(u, v)
+
+			results.append((self._snapshot(), N.sqrt(max(self._error, 0.0))))
+
+		return results
+
+
+
+# simplifies the triangles (a GL_TRIANGLES index list) down to target_triangles, or
+# as close as possible while keeping the borders and not folding triangles over.
+# Returns the new indices, which use the same vertices
+def simplify(positions, indices, target_triangles):
+	return _Simplifier(positions, indices).run([target_triangles])[0][0]
+
+
+# builds levels of detail for the triangles in [first_index, first_index+total_indices)
+# of indices_vbo, with ratios of the original number of triangles, appending them to
+# indices_vbo. Returns a list of LodLevel, from the most detailed
+def buildLodChain(data_vbo, indices_vbo, first_index=0, total_indices=None, ratios=(0.5, 0.25, 0.125), position_field="position"):
+	indices = indices_vbo.getBuffer().ravel()
+	if total_indices is None:
+		total_indices = indices.size - first_index
+
+	indices = indices[first_index:first_index+total_indices]
+	total_tris = total_indices // 3
+
+	s = _Simplifier(data_vbo.getSlice(position_field), indices)
+	results = s.run([int(total_tris * r) for r in sorted(ratios, reverse=True)])
+
+	firsts = indices_vbo.appendIndices([lod for lod, error in results])
+
+	return [LodLevel(first, lod.size // 3, error) for first, (lod, error) in zip(firsts, results)]
@@ -24,6 +24,7 @@ SOFTWARE.
 
 
 
+import weakref
 from glcompat import *
 from texture import Texture
 from mathtools import floatArray
@@ -90,6 +91,8 @@ class Material:
 
 
 # if shader==None, then the material must specify which shader to use
+# the binder only holds a weak reference to the material, so it can be cached with
+# the material as key (see ObjManager): it must not be used once the material is gone
 	def toCompiled(self, shader=None):
 
 		if shader is None:
@@ -133,7 +136,7 @@ class Material:
 
 		c = compile(code, "<compiled material>", "exec")
 
-		ns = dict(mat = self, glUniform3fv=glUniform3fv, glUniform1f=glUniform1f)
+		ns = dict(mat = weakref.proxy(self), glUniform3fv=glUniform3fv, glUniform1f=glUniform1f)
 	
 		exec c in ns
 
@@ -60,6 +60,25 @@ def toNumpyArray(d, npy_type="auto"):
 		return N.array(d, dtype = npy_type)
 
 
+# wraps any C-contiguous buffer (numpy array, memoryview, mmap, bytes...) as a numpy
+# array of the given type without copying it and without looking at the values.
+# Raises ValueError instead of copying when that's not possible
+def bufferAsArray(d, npy_type):
+	npy_type = N.dtype(npy_type)
+
+	if isNumpyArray(d):
+		if not d.flags.c_contiguous:
+			raise ValueError("Buffer is not C-contiguous")
+		if d.dtype != npy_type:
+			raise ValueError("Buffer is of type %s, not %s"%(d.dtype, npy_type))
+		return d
+
+	try:
+		return N.frombuffer(d, dtype=npy_type)
+	except (TypeError, ValueError, AttributeError) as e:
+		raise ValueError("Can't use %s as a contiguous buffer of %s: %s"%(type(d).__name__, npy_type, e))
+
+
 def cartesianProduct(arrays):
 	broadcastable = N.ix_(*arrays)
 	broadcasted = N.broadcast_arrays(*broadcastable)
@@ -90,6 +109,19 @@ def planeNormal(p0,p1,p2):
 
 
 
+# the ray (origin, unit direction) through the point (ndc_x, ndc_y) of the screen, in
+# normalized device coordinates ([-1..1]), from the inverse of proj_view_m (eg.
+# projection*view, for a world space ray)
+def unprojectRay(proj_view_m, ndc_x, ndc_y):
+	inv = T.inverse_matrix(proj_view_m)
+	near = N.dot(inv, [ndc_x, ndc_y, -1.0, 1.0])
+	far = N.dot(inv, [ndc_x, ndc_y, 1.0, 1.0])
+	near = near[:3] / near[3]
+	far = far[:3] / far[3]
+	return near, T.unit_vector(far - near)
+
+
+
 def lookAtMtx(eye, target, up):
 	fwd = target - eye
 	fwd = T.unit_vector(fwd)
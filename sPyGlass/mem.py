@@ -1,3 +1,9 @@
+import bisect
+import time
+import weakref
+from collections import namedtuple
+
+
 
 class FreeBlock:
 	def __init__(self, page, start, size):
@@ -27,6 +33,7 @@ class AllocatedBlock:
 		self._start = start
 		self._size = size
 		self._id = id
+		self._owner = None
 
 	def free(self):
 		self._manager.free(self)
@@ -47,18 +54,182 @@ class AllocatedBlock:
 	def page_data(self):
 		return self._manager.getPageData(self._page)
 
+	# the owner is notified with owner.blockMoved(block) when the manager relocates
+	# the block (eg. while compacting). Only a weak reference to it is kept
+	def setOwner(self, owner):
+		self._owner = weakref.ref(owner) if owner is not None else None
+
+	def _notifyMoved(self):
+		owner = self._owner() if self._owner is not None else None
+		if owner is not None:
+			owner.blockMoved(self)
+
 	def __str__(self):
 		return "<Allocated block %s [%s:%s-%s] of size %s>"%(self._id, self._page, self._start, self._start+self._size, self._size)
 
 
-class MemoryManager(object):
+# Free block lookup policies. A policy only has to find a free block large enough for
+# a request; coalescing of neighbouring free blocks is done by the MemoryManager through
+# its address indices, so it is O(1) regardless of the policy used.
+# A policy must implement insert(fb), remove(fb), find(size), __iter__ and __len__
+
+class BestFitPolicy(object):
+	# keeps free blocks sorted by (size, page, start), so the smallest block that fits
+	# (the lowest addressed one among equally sized blocks) is found with a binary search
+	def __init__(self):
+		self._keys = []
+		self._blocks = []
+
+	def insert(self, fb):
+		k = (fb.size, fb.page, fb.start)
+		i = bisect.bisect_left(self._keys, k)
+		self._keys.insert(i, k)
+		self._blocks.insert(i, fb)
+
+	def remove(self, fb):
+		i = bisect.bisect_left(self._keys, (fb.size, fb.page, fb.start))
+		del self._keys[i]
+		del self._blocks[i]
+
+	def find(self, size):
+		i = bisect.bisect_left(self._keys, (size,))
+		if i == len(self._keys):
+			return None
+		return self._blocks[i]
+
+	def __iter__(self):
+		return iter(list(self._blocks))
+
+	def __len__(self):
+		return len(self._blocks)
+
+
+
+class SegregatedFitPolicy(object):
+	# free blocks are kept in bins by power of two size class: bin c holds the blocks
+	# with a size in [2^c, 2^(c+1)), sorted by (size, page, start). The first block
+	# that fits in the requested class is found with a binary search, and any block
+	# from the next non empty class fits. A bit mask of the non empty bins makes the
+	# jump to that class O(1)
 	def __init__(self):
+		self._bins = {} # size class -> ([(size, page, start)], [block]), sorted
+		self._mask = 0
+		self._count = 0
+
+	def insert(self, fb):
+		c = _sizeClass(fb.size)
+		try:
+			keys, blocks = self._bins[c]
+		except KeyError:
+			keys, blocks = self._bins[c] = ([], [])
+
+		k = (fb.size, fb.page, fb.start)
+		i = bisect.bisect_left(keys, k)
+		keys.insert(i, k)
+		blocks.insert(i, fb)
+		self._mask |= 1 << c
+		self._count += 1
+
+	def remove(self, fb):
+		c = _sizeClass(fb.size)
+		keys, blocks = self._bins[c]
+		i = bisect.bisect_left(keys, (fb.size, fb.page, fb.start))
+		del keys[i]
+		del blocks[i]
+		if not keys:
+			del self._bins[c]
+			self._mask &= ~(1 << c)
+		self._count -= 1
+
+	def find(self, size):
+		c = _sizeClass(size)
+
+		bin = self._bins.get(c)
+		if bin is not None:
+			i = bisect.bisect_left(bin[0], (size,))
+			if i < len(bin[0]):
+				return bin[1][i]
+
+		m = self._mask >> (c+1)
+		if not m:
+			return None
+
+		c += _sizeClass(m & -m) + 1
+		return self._bins[c][1][0]
+
+	def __iter__(self):
+		return iter([fb for keys, blocks in self._bins.values() for fb in blocks])
+
+	def __len__(self):
+		return self._count
+
+
+
+def _sizeClass(size):
+	return max(int(size), 1).bit_length() - 1
+
+
+
+class MemoryManager(object):
+
+	Stats = namedtuple("Stats",[
+				"pages", # list of PageStats, for the pages in use
+				"used_bytes",
+				"free_bytes",
+				"largest_free_bytes",
+				"free_blocks",
+				"allocated_blocks",
+				"retired_bytes", # freed, but waiting for the GPU to finish with them
+				"fragmentation", # 1 - largest free block / total free. 0 when not fragmented
+				"allocs",
+				"frees",
+				"page_allocs",
+				"page_releases",
+			])
+
+	PageStats = namedtuple("PageStats",[
+				"page",
+				"size_bytes",
+				"used_bytes",
+				"free_bytes",
+				"largest_free_bytes",
+				"free_blocks",
+			])
+
+	# size in bytes of the unit blocks are measured in; used only for the stats
+	_unit_bytes = 1
+
+	# policy is the class of the free block lookup policy to use (see BestFitPolicy)
+	# if deferred_free is True, freed ranges aren't reused until the frame in which
+	# they were freed has been completed by the GPU (see endFrame)
+	def __init__(self, policy=BestFitPolicy, deferred_free=False):
 		self._allocated_blocks = {} # map of allocated blocks by ID
-		self._free_blocks = [] # list of free blocks
+		self._free_blocks = policy() # free blocks, as indexed by the policy
+		self._free_by_start = {} # (page, start) -> free block
+		self._free_by_end = {} # (page, end) -> free block
 		self._pages = []
-		self._free_blocks_by_address = False
+		self._page_sizes = []
+		self._page_free = [] # free units per page
 		self._current_id = 1
 
+		self._deferred_free = deferred_free
+		self._pending_ranges = [] # ranges freed during the current frame
+		self._retired = [] # (fence, ranges) of past frames, oldest first
+
+		self._max_free_pages = 0
+		self._idle_timeout = None
+		self._auto_trim = False
+		self._empty_since = {} # page id -> time it was first seen empty
+
+		self._max_bytes = None
+		self._evict_hook = None
+
+		self._page_alloc_hook = None
+		self._allocs = 0
+		self._frees = 0
+		self._page_allocs = 0
+		self._page_releases = 0
+
 
 	def _allocNewPage(self,min_size):
 		raise RuntimeError("Must subclass from MemoryManager")
@@ -66,56 +237,217 @@ class MemoryManager(object):
 		#return None,min_size
 
 
+	# must copy size units of data from one page to another (or within a page). The
+	# ranges never overlap
+	def _moveData(self, src_page, src_start, dst_page, dst_start, size):
+		raise RuntimeError("Must subclass from MemoryManager to move blocks")
+
+
+	# size of the page _allocNewPage would return for a request of min_size units.
+	# Used to enforce the memory limit before actually allocating
+	def _pageSizeFor(self, min_size):
+		return min_size
+
+
+	# called once a page is no longer used, before its data is dropped
+	def _releasePage(self, page_id, page_data):
+		pass
+
+
+	# fences are used to know when the GPU is done with a frame. The default ones
+	# are always signaled, so retired ranges are reclaimed on the next endFrame
+	def _insertFence(self):
+		return None
+
+
+	def _isFenceSignaled(self, fence):
+		return True
+
+
+	def _deleteFence(self, fence):
+		pass
+
+
+	# blocks until the fence is signaled
+	def _waitFence(self, fence):
+		pass
+
+
+	def _addPage(self, page_data, page_size):
+		# reuse the slot of a released page, so page ids stay small
+		try:
+			page_id = self._pages.index(None)
+			self._pages[page_id] = page_data
+			self._page_sizes[page_id] = page_size
+		except ValueError:
+			page_id = len(self._pages)
+			self._pages.append(page_data)
+			self._page_sizes.append(page_size)
+			self._page_free.append(0)
+
+		fb = FreeBlock(page_id, 0, page_size)
+		self._linkFree(fb)
+
+		self._page_allocs += 1
+		if self._page_alloc_hook is not None:
+			self._page_alloc_hook(self, page_id, page_size)
+
+		return fb
+
+
 	def _newId(self):
 		self._current_id+=1
 		return self._current_id-1
 
+
+	def _linkFree(self, fb):
+		self._free_blocks.insert(fb)
+		self._free_by_start[(fb.page, fb.start)] = fb
+		self._free_by_end[(fb.page, fb.start+fb.size)] = fb
+		self._page_free[fb.page] += fb.size
+
+
+	def _unlinkFree(self, fb):
+		self._free_blocks.remove(fb)
+		del self._free_by_start[(fb.page, fb.start)]
+		del self._free_by_end[(fb.page, fb.start+fb.size)]
+		self._page_free[fb.page] -= fb.size
+
+
 	def getPageData(self, page_id):
 		return self._pages[page_id]
 
+
 	def free(self, allocated_block):
 		id = allocated_block._id
 		try:
-			b = self._allocated_blocks[id]
+			b = self._allocated_blocks.pop(id)
 		except:
 			return
 
 		if b is None: return
 
-		self._free_blocks.append(FreeBlock.fromAllocated(b))
-		self._free_blocks.sort(key=lambda block:(block.page, block.start))
-		del self._allocated_blocks[id]
-		# see if we can merge blocks
+		self._frees += 1
 
-		updated_blocks_list = []
+		if self._deferred_free:
+			self._pending_ranges.append((b._page, b._start, b._size))
+		else:
+			self._releaseRange(b._page, b._start, b._size)
 
-		last_fb = self._free_blocks[0]
-		merged = True
-		for i in xrange(1, len(self._free_blocks)):
-			merged = False
-			fb = self._free_blocks[i]
 
-			if last_fb.page == fb.page and last_fb.start+last_fb.size == fb.start:
-				last_fb.expandTail(fb.size)
-				merged = True
-				continue
+	# to be called once per frame, after submitting its draw calls, when using
+	# deferred_free. The ranges freed during the frame are retired until the GPU is
+	# done with it, and those retired in past frames that are safe are reclaimed
+	def endFrame(self):
+		self._retirePending()
+		self._reclaimRetired()
+
+		if self._auto_trim:
+			self.trim()
+
+
+	def _retirePending(self):
+		if self._pending_ranges:
+			self._retired.append((self._insertFence(), self._pending_ranges))
+			self._pending_ranges = []
+
+
+	# if wait is True, waits for the GPU to be done with all the retired ranges
+	def _reclaimRetired(self, wait=False):
+		while self._retired:
+			fence, ranges = self._retired[0]
+			# the fences signal in order, so stop at the first pending one
+			if not self._isFenceSignaled(fence):
+				if not wait:
+					break
+				self._waitFence(fence)
 
-			updated_blocks_list.append(last_fb)
+			self._retired.pop(0)
+			self._deleteFence(fence)
+			for r in ranges:
+				self._releaseRange(*r)
 
-			last_fb = fb
 
-		if merged:
-			updated_blocks_list.append(last_fb)
+	def _releaseRange(self, page, start, size):
+		# merge with the free blocks right before and after this one, if any
+		prev_fb = self._free_by_end.get((page, start))
+		next_fb = self._free_by_start.get((page, start+size))
 
+		if prev_fb is not None:
+			self._unlinkFree(prev_fb)
+			prev_fb.expandTail(size)
+			fb = prev_fb
+		else:
+			fb = FreeBlock(page, start, size)
+
+		if next_fb is not None:
+			self._unlinkFree(next_fb)
+			fb.expandTail(next_fb.size)
+
+		self._linkFree(fb)
+
+
+	def _retiredUnits(self):
+		total = sum(size for page, start, size in self._pending_ranges)
+		for fence, ranges in self._retired:
+			total += sum(size for page, start, size in ranges)
+		return total
 
-		self._free_blocks = updated_blocks_list
-		self._free_blocks_by_address = True
+
+	# hook(manager, page_id, page_size) is called every time a new page is allocated
+	def setPageAllocHook(self, hook):
+		self._page_alloc_hook = hook
+
+
+	# cheap summary of the state of the allocator. Only walks the free blocks
+	def stats(self):
+		ub = self._unit_bytes
+
+		largest = [0] * len(self._pages)
+		count = [0] * len(self._pages)
+		for fb in self._free_by_start.itervalues():
+			largest[fb.page] = max(largest[fb.page], fb.size)
+			count[fb.page] += 1
+
+		pages = []
+		for page_id, page_data in enumerate(self._pages):
+			if page_data is None:
+				continue
+
+			size = self._page_sizes[page_id]
+			free = self._page_free[page_id]
+			pages.append(self.PageStats(
+					page = page_id,
+					size_bytes = size * ub,
+					used_bytes = (size - free) * ub,
+					free_bytes = free * ub,
+					largest_free_bytes = largest[page_id] * ub,
+					free_blocks = count[page_id],
+				))
+
+		free = sum(p.free_bytes for p in pages)
+		largest_free = max([p.largest_free_bytes for p in pages] or [0])
+
+		return self.Stats(
+				pages = pages,
+				used_bytes = sum(p.used_bytes for p in pages),
+				free_bytes = free,
+				largest_free_bytes = largest_free,
+				free_blocks = len(self._free_by_start),
+				allocated_blocks = len(self._allocated_blocks),
+				retired_bytes = ub * self._retiredUnits(),
+				fragmentation = 1.0 - float(largest_free) / free if free else 0.0,
+				allocs = self._allocs,
+				frees = self._frees,
+				page_allocs = self._page_allocs,
+				page_releases = self._page_releases,
+			)
 
 
 	def dump(self):
 		print "dump ---------------"
 		print "Free blocks:"
-		for bk in self._free_blocks:
+		for bk in sorted(self._free_blocks, key=lambda block:(block.page, block.start)):
 			print bk
 		print "Allocated blocks:"
 		for bk in self._allocated_blocks.values():
@@ -123,47 +455,259 @@ class MemoryManager(object):
 		print "--------------------"
 
 
-	def alloc(self, size):
-		if self._free_blocks_by_address:
-			self._free_blocks.sort(key=lambda block:block.size)
-			self._free_blocks_by_address = False
+	# finds (or makes room for) a free block of at least size units and unlinks it
+	def _takeFreeBlock(self, size):
+		fb = self._free_blocks.find(size)
 
-		lo = 0
-		tot = hi = len(self._free_blocks)
+		if fb is None and self._retired:
+			self._reclaimRetired()
+			fb = self._free_blocks.find(size)
 
-		while lo < hi:
-			mid = (lo+hi)//2
-			if self._free_blocks[mid].size < size: lo = mid+1
-			else: hi = mid
+		if fb is None and self._max_bytes is not None:
+			fb = self._makeRoomFor(size)
 
-		if lo == tot: # no free block large enough. Request another page
+		if fb is None: # no free block large enough. Request another page
 			#print "Not enough space, requesting a new page"
-			page_num = len(self._pages)
-
 			d_s = self._allocNewPage(size)
 
 			if d_s:
 				page_data, page_size = d_s
-				self._free_blocks.append(FreeBlock(page_num, 0, page_size))
-
-				self._pages.append(page_data)
-				tot = len(self._free_blocks)
+				fb = self._addPage(page_data, page_size)
+				if page_size < size:
+					fb = None
 
-		if lo == tot:
+		if fb is None:
 			raise MemoryError("No memory to allocate another page")
 
-		fb = self._free_blocks[lo]
+		self._unlinkFree(fb)
+		return fb
 
+
+	# carves an allocated block from the head of the (unlinked) free block fb
+	def _carve(self, fb, size):
 		block_id = self._newId()
 
 		block = AllocatedBlock(self, fb.page, fb.start, size, block_id)
 
-		if fb.size == size:
-			del self._free_blocks[lo] # block completely used
-		else:
-			self._free_blocks[lo].reduceHead(size)
+		fb.reduceHead(size)
 
 		self._allocated_blocks[block_id] = block
+		self._allocs += 1
+
+		return block
+
+
+	def alloc(self, size):
+		fb = self._takeFreeBlock(size)
+
+		block = self._carve(fb, size)
+
+		if fb.size: # otherwise the block is completely used
+			self._linkFree(fb)
 
 		return block
 
+
+	# allocates a block for each size with a single free block lookup. The blocks are
+	# contiguous, in the same order as sizes, and all lie in the same page
+	def allocMany(self, sizes):
+		if not sizes:
+			return []
+
+		fb = self._takeFreeBlock(sum(sizes))
+
+		blocks = [self._carve(fb, size) for size in sizes]
+
+		if fb.size:
+			self._linkFree(fb)
+
+		return blocks
+
+
+	# frees all the blocks, merging the ranges of adjacent ones before returning them
+	# to the free blocks
+	def freeMany(self, blocks):
+		ranges = []
+		for block in blocks:
+			b = self._allocated_blocks.pop(block._id, None)
+			if b is not None:
+				ranges.append((b._page, b._start, b._size))
+				self._frees += 1
+
+		if self._deferred_free:
+			self._pending_ranges.extend(ranges)
+			return
+
+		ranges.sort()
+
+		run = None
+		for page, start, size in ranges:
+			if run is not None and run[0] == page and run[1] + run[2] == start:
+				run[2] += size
+				continue
+
+			if run is not None:
+				self._releaseRange(*run)
+
+			run = [page, start, size]
+
+		if run is not None:
+			self._releaseRange(*run)
+
+
+	def _isPageEmpty(self, page_id):
+		fb = self._free_by_start.get((page_id, 0))
+		return fb is not None and fb.size == self._page_sizes[page_id]
+
+
+	def _emptyPages(self):
+		return [page_id for page_id, page_data in enumerate(self._pages) if page_data is not None and self._isPageEmpty(page_id)]
+
+
+	def _releasePageAt(self, page_id):
+		page_data = self._pages[page_id]
+		self._unlinkFree(self._free_by_start[(page_id, 0)])
+		self._pages[page_id] = None
+		self._page_sizes[page_id] = 0
+		self._empty_since.pop(page_id, None)
+		self._releasePage(page_id, page_data)
+		self._page_releases += 1
+
+
+	def releaseEmptyPages(self):
+		empty = self._emptyPages()
+		for page_id in empty:
+			self._releasePageAt(page_id)
+
+		return len(empty)
+
+
+	# sets how trim() releases the pages that are completely free:
+	#   max_free_pages: how many empty pages are kept around to be reused
+	#   idle_timeout: seconds a page must have been empty before it can be released
+	#     (None to release it as soon as it's empty)
+	#   auto: if True, trim() is called by endFrame()
+	def setTrimPolicy(self, max_free_pages=0, idle_timeout=None, auto=True):
+		self._max_free_pages = max_free_pages
+		self._idle_timeout = idle_timeout
+		self._auto_trim = auto
+
+
+	# releases the empty pages, as allowed by the trim policy. Returns how many
+	def trim(self):
+		now = time.time()
+
+		empty = self._emptyPages()
+
+		for page_id in self._empty_since.keys():
+			if page_id not in empty:
+				del self._empty_since[page_id]
+
+		for page_id in empty:
+			self._empty_since.setdefault(page_id, now)
+
+		# the lowest pages are the ones kept
+		candidates = empty[self._max_free_pages:]
+
+		if self._idle_timeout is not None:
+			candidates = [page_id for page_id in candidates if now - self._empty_since[page_id] >= self._idle_timeout]
+
+		for page_id in candidates:
+			self._releasePageAt(page_id)
+
+		return len(candidates)
+
+
+	# limits the memory used by all the pages together to max_bytes (None for no limit).
+	# When a new page would exceed it, the empty pages are released and then
+	# evict_hook(manager, size) is called, so the application can free some blocks. It
+	# must return False once it has nothing else to evict, and a MemoryError is raised.
+	# With deferred_free, the blocks it frees are reused right away, after waiting for
+	# the GPU to be done with the commands submitted so far
+	def setMemoryLimit(self, max_bytes, evict_hook=None):
+		self._max_bytes = max_bytes
+		self._evict_hook = evict_hook
+
+
+	# returns a free block for size units if evicting makes one available, or None if
+	# a new page can be allocated within the memory limit
+	def _makeRoomFor(self, size):
+		ub = self._unit_bytes
+		new_page_bytes = self._pageSizeFor(size) * ub
+
+		while sum(self._page_sizes) * ub + new_page_bytes > self._max_bytes:
+			if self.releaseEmptyPages():
+				continue
+
+			if self._evict_hook is None or not self._evict_hook(self, size):
+				raise MemoryError("Memory limit of %s bytes reached"%self._max_bytes)
+
+			# the evicted blocks may still be in use by the GPU
+			self._retirePending()
+			self._reclaimRetired(wait=True)
+
+			fb = self._free_blocks.find(size)
+			if fb is not None:
+				return fb
+
+		return None
+
+
+	# returns the free block the policy picks for the block (a single lookup, O(log
+	# free blocks) with the bundled policies) if it lies before it, or None. Larger free
+	# blocks further down are not considered, so a block may stay where it is even
+	# if there's room for it before
+	def _findLowerFreeBlock(self, block):
+		fb = self._free_blocks.find(block._size)
+
+		if fb is not None and (fb.page, fb.start) < (block._page, block._start):
+			return fb
+
+		return None
+
+
+	def _moveBlock(self, block, fb):
+		self._unlinkFree(fb)
+
+		self._moveData(block._page, block._start, fb.page, fb.start, block._size)
+
+		old_page, old_start = block._page, block._start
+		block._page, block._start = fb.page, fb.start
+
+		if fb.size != block._size:
+			fb.reduceHead(block._size)
+			self._linkFree(fb)
+
+		# the GPU may still be drawing from the old range
+		if self._deferred_free:
+			self._pending_ranges.append((old_page, old_start, block._size))
+		else:
+			self._releaseRange(old_page, old_start, block._size)
+
+		block._notifyMoved()
+
+
+	# moves the allocated blocks towards the start of the first pages, filling the holes
+	# left by freed blocks, and then releases the pages that end up empty.
+	# If time_budget (in seconds) is given, stops once it has been used up, so it can
+	# be called once per frame to compact incrementally.
+	# Returns True when there's nothing else to move
+	def compact(self, time_budget=None):
+		t_end = time.time() + time_budget if time_budget is not None else None
+
+		# the blocks at the end are moved first
+		blocks = sorted(self._allocated_blocks.values(), key=lambda block:(block._page, block._start), reverse=True)
+
+		for block in blocks:
+			if t_end is not None and time.time() > t_end:
+				return False
+
+			if block._id not in self._allocated_blocks: # freed by the owner of a moved block
+				continue
+
+			fb = self._findLowerFreeBlock(block)
+			if fb is not None:
+				self._moveBlock(block, fb)
+
+		self.releaseEmptyPages()
+		return True
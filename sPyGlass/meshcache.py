@@ -0,0 +1,170 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Binary mesh cache. Geometry built (or imported) once is saved with saveMesh, and
+# later loaded with loadMesh by memory mapping the file: the vertex and index data
+# are handed to the VBOs as they are, so loading costs an mmap plus the GL upload.
+#
+# File layout:
+#   magic (8 bytes), version (uint32), header size (uint32)
+#   header: JSON with the data layout, the fields and the batch table
+#   vertex data, at header["data_offset"]
+#   index data, at header["index_offset"]
+# The data blocks are aligned to _ALIGNMENT bytes.
+
+import json
+import struct
+import numpy as N
+from collections import namedtuple
+from glcompat import *
+from vbo import DataVbo, IndexVbo
+from objmanager import ObjManager
+import resources as R
+
+
+_MAGIC = "SPGMESH\0"
+_VERSION = 1
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGNMENT = 16
+
+
+class MeshCacheError(ValueError):
+	pass
+
+
+# shader is the name of a shader program, and material a material description as
+# used by resources.loadMaterial (eg. "default:red_plastic")
+MeshBatch = namedtuple("MeshBatch",[
+			"shader",
+			"material",
+			"first_index",
+			"total_primitives",
+			"primitive_type",
+		])
+
+
+Mesh = namedtuple("Mesh",[
+			"data_vbo",
+			"indices_vbo",
+			"batches",
+		])
+
+
+def _align(offset):
+	return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+# batches is a list of MeshBatch (or of tuples with the same fields)
+def saveMesh(filename, data_vbo, indices_vbo, batches=()):
+	data = N.ascontiguousarray(data_vbo.getBuffer())
+	indices = N.ascontiguousarray(indices_vbo.getBuffer()).ravel()
+
+	header = {
+		"data_dtype": data.dtype.str,
+		"records": data.shape[0],
+		"items_per_record": data.size // data.shape[0],
+		"fields": data_vbo.getFields(),
+		"index_dtype": indices.dtype.str,
+		"indices": indices.size,
+		"batches": [dict(MeshBatch(*b)._asdict(), primitive_type=int(b[4])) for b in batches],
+	}
+
+	# the offsets are part of the header, so its size must be known first
+	header["data_offset"] = header["index_offset"] = 0
+	size = len(json.dumps(header)) + 2 * 20 # room for the offsets
+
+	header["data_offset"] = _align(_PREAMBLE.size + size)
+	header["index_offset"] = _align(header["data_offset"] + data.nbytes)
+
+	h = json.dumps(header).ljust(size)
+
+	with open(filename, "wb") as f:
+		f.write(_PREAMBLE.pack(_MAGIC, _VERSION, len(h)))
+		f.write(h)
+		f.write("\0" * (header["data_offset"] - f.tell()))
+		f.write(data.tostring())
+		f.write("\0" * (header["index_offset"] - f.tell()))
+		f.write(indices.tostring())
+
+
+def _readHeader(filename):
+	with open(filename, "rb") as f:
+		pre = f.read(_PREAMBLE.size)
+		if len(pre) != _PREAMBLE.size:
+			raise MeshCacheError("%s: not a mesh cache file"%filename)
+
+		magic, version, size = _PREAMBLE.unpack(pre)
+		if magic != _MAGIC:
+			raise MeshCacheError("%s: not a mesh cache file"%filename)
+		if version != _VERSION:
+			raise MeshCacheError("%s: unsupported mesh cache version %s"%(filename, version))
+
+		return json.loads(f.read(size))
+
+
+# returns a Mesh, with the VBOs created straight from the memory mapped file
+def loadMesh(filename, usage = GL_STATIC_DRAW):
+	header = _readHeader(filename)
+
+	data = N.memmap(filename, dtype=str(header["data_dtype"]), mode="r",
+				offset=header["data_offset"],
+				shape=(header["records"], header["items_per_record"]))
+
+	indices = N.memmap(filename, dtype=str(header["index_dtype"]), mode="r",
+				offset=header["index_offset"],
+				shape=(header["indices"],))
+
+	data_vbo = DataVbo.fromBuffer(data, data.dtype, header["items_per_record"], usage)
+	# (name, size, type, normalized, offset)
+	data_vbo.defineFields(*[(str(f[0]), f[1], str(f[2]), f[3], f[4]) for f in header["fields"]])
+
+	indices_vbo = IndexVbo.fromBuffer(indices, indices.dtype, usage)
+
+	batches = [MeshBatch(
+			shader = str(b["shader"]),
+			material = str(b["material"]),
+			first_index = b["first_index"],
+			total_primitives = b["total_primitives"],
+			primitive_type = b["primitive_type"],
+		) for b in header["batches"]]
+
+	return Mesh(data_vbo, indices_vbo, batches)
+
+
+# an ObjManager for a cached mesh, with its batches set up from the batch table
+class CachedMesh(ObjManager):
+	def __init__(self, filename):
+		mesh = loadMesh(filename)
+
+		super(CachedMesh,self).__init__(mesh.data_vbo, mesh.indices_vbo)
+
+		self._mesh_batches = mesh.batches
+
+		for b in mesh.batches:
+			self.addBatch(R.loadShaderProgram(b.shader), R.loadMaterial(b.material), b.first_index, b.total_primitives, b.primitive_type)
+
+
+	def save(self, filename):
+		saveMesh(filename, self._data_vbo, self._indices_vbo, self._mesh_batches)
@@ -0,0 +1,177 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Index buffer tools: choosing the narrowest index type, and reordering triangles
+# and vertices so the GPU's post-transform cache and vertex fetches work better.
+# The reordering works on triangle lists (GL_TRIANGLES)
+
+import numpy as N
+
+
+# the smallest unsigned type that can hold max_index
+def minimalIndexType(max_index):
+	if max_index < 256:
+		return N.dtype("u1")
+	if max_index < 65536:
+		return N.dtype("u2")
+	return N.dtype("u4")
+
+
+# returns the indices as the narrowest type able to hold them
+def narrowIndices(indices):
+	indices = N.asarray(indices).ravel()
+	if not indices.size:
+		return indices.astype("u2")
+	return indices.astype(minimalIndexType(int(indices.max())))
+
+
+# average number of vertices transformed per triangle with a FIFO cache of
+# cache_size vertices (ACMR). Lower is better: 0.5 is ideal, 3 is the worst
+def averageCacheMissRatio(indices, cache_size=32):
+	indices = N.asarray(indices).ravel().tolist()
+	if not indices:
+		return 0.0
+
+	cache = []
+	in_cache = set()
+	misses = 0
+	for v in indices:
+		if v in in_cache:
+			continue
+		misses += 1
+		cache.append(v)
+		in_cache.add(v)
+		if len(cache) > cache_size:
+			in_cache.discard(cache.pop(0))
+
+	return misses / (len(indices) / 3.0)
+
+
+# reorders the triangles for post-transform vertex cache locality, with the Tipsify
+# algorithm (Sander, Nehab & Barczak 2007), which runs in linear time. Returns the
+# reordered indices (same triangles, same winding)
+def optimizeVertexCache(indices, total_vertices=None, cache_size=32):
+	indices = N.asarray(indices).ravel()
+	if indices.size < 6:
+		return indices.copy()
+
+	if total_vertices is None:
+		total_vertices = int(indices.max()) + 1
+
+	tris = indices.reshape(-1, 3)
+	total_tris = len(tris)
+
+	# triangles using each vertex: adj[adj_start[v]:adj_start[v+1]]
+	live = N.bincount(indices, minlength=total_vertices)
+	adj_start = N.concatenate([[0], N.cumsum(live)]).tolist()
+	adj = (N.argsort(indices, kind="mergesort") // 3).tolist()
+
+	tris_l = tris.tolist()
+	live = live.tolist()
+	cache_time = [0] * total_vertices
+	emitted = [False] * total_tris
+	dead_end = []
+	out = []
+
+	timestamp = cache_size + 1
+	cursor = 0
+	f = int(indices[0])
+
+	while f >= 0:
+		candidates = []
+
+		for t in adj[adj_start[f]:adj_start[f+1]]:
+			if emitted[t]:
+				continue
+
+			emitted[t] = True
+			for v in tris_l[t]:
+				out.append(v)
+				dead_end.append(v)
+				candidates.append(v)
+				live[v] -= 1
+				if timestamp - cache_time[v] > cache_size:
+					cache_time[v] = timestamp
+					timestamp += 1
+
+		# next fanning vertex: the one with live triangles that stays longest in
+		# the cache after emitting them
+		f = -1
+		best = -1
+		for v in candidates:
+			if live[v] <= 0:
+				continue
+			p = 0
+			if timestamp - cache_time[v] + 2 * live[v] <= cache_size:
+				p = timestamp - cache_time[v]
+			if p > best:
+				best = p
+				f = v
+
+		if f < 0:
+			# dead end: go back to recently used vertices, and then to the next
+			# vertex in input order with live triangles
+			while dead_end:
+				v = dead_end.pop()
+				if live[v] > 0:
+					f = v
+					break
+
+		if f < 0:
+			while cursor < total_vertices:
+				if live[cursor] > 0:
+					f = cursor
+					break
+				cursor += 1
+
+	return N.array(out, dtype=indices.dtype)
+
+
+# renumbers the vertices in the order they are first used by the indices, so vertex
+# fetches walk the vertex data forward. Unused vertices are moved to the end.
+# Returns the new indices and remap, so that the new number of vertex v is remap[v]
+def optimizeVertexFetch(indices, total_vertices=None):
+	indices = N.asarray(indices).ravel()
+
+	if total_vertices is None:
+		total_vertices = int(indices.max()) + 1 if indices.size else 0
+
+	used, first = N.unique(indices, return_index=True)
+	order = used[N.argsort(first, kind="mergesort")]
+
+	unused = N.setdiff1d(N.arange(total_vertices), used)
+	order = N.concatenate([order, unused]).astype("i8")
+
+	remap = N.empty(total_vertices, dtype="u4")
+	remap[order] = N.arange(total_vertices, dtype="u4")
+
+	return remap[indices].astype(indices.dtype), remap
+
+
+# returns the vertex data rearranged as told by a remap from optimizeVertexFetch
+def remapVertices(data, remap):
+	out = N.empty_like(data)
+	out[remap] = data
+	return out
@@ -25,7 +25,12 @@ SOFTWARE.
 
 from glcompat import *
 from collections import namedtuple
-from vao import Vao
+from vao import Vao, FormatVao
+from cache import ObjectCache
+from vbo import Vbo, DataVbo
+from culling import frustumPlanes, spheresInFrustum, boxesInFrustum, transformSpheres, transformBoxes
+import bisect
+import numpy as N
 
 
 class ObjManager(object):
@@ -47,50 +52,158 @@ class ObjManager(object):
 				"total_points",
 				"data_type",
 				"offset",
+				"first_index",
 			])
 
-	_mbinder_cache = {}
+	# shared by all the managers
+	_mbinder_cache = ObjectCache(max_size=256)
 
-	_vao_cache = {}
+	_vao_cache = ObjectCache(max_size=256)
+
+	# one FormatVao per vertex format and shader, instead of a Vao per DataVbo
+	_shared_vaos = False
+
+	# hardware instancing for drawMany, see _canInstance
+	_instancing = None # unknown until the first drawMany
+	_instance_dtype = N.dtype([("instance_m", "f4", 16), ("instance_color", "f4", 4)])
+	_instance_vbo = None
+
+	_identity = N.identity(4)
+
+	# skip the objects and instances outside the view frustum, see setFrustumCulling
+	_culling = False
+
+	# multi draw modes, see setMultiDraw
+	MULTI_DRAW = "multi" # glMultiDrawElements
+	MULTI_DRAW_INDIRECT = "indirect" # glMultiDrawElementsIndirect, from a GPU buffer
+	_multi_draw = None
+
+	# consecutive batches with the same state, drawn with a single call
+	DrawGroup = namedtuple("DrawGroup",[
+				"shader",
+				"mbinder",
+				"vao",
+				"primitive_type",
+				"data_type",
+				"first_command", # in the indirect buffer
+				"total_commands",
+				"counts",
+				"offsets",
+				"base_vertices",
+			])
+
+	# DrawElementsIndirectCommand
+	_indirect_dtype = N.dtype([("count", "u4"), ("instance_count", "u4"), ("first_index", "u4"), ("base_vertex", "i4"), ("base_instance", "u4")])
 
 
 	def __init__(self, data_vbo, indices_vbo):
-		self._data_vbo = data_vbo
+		self._data_vbo = None
 		self._indices_vbo = indices_vbo
 		self._batches = []
 		self._last_shader = None
 		self._last_mbinder = None
 		self._transform = None
+		self._lod_sizes = [] # sorted
+		self._lod_batches = [] # the batches of each size in _lod_sizes
+		self._bounding_sphere = None
+		self._bounding_box = None
+		self._bounds_set = False # set with setBoundingSphere, kept on changes
+		self._bounds_version = None # data version of the DataVbo the bounds were computed for
+		self._draw_groups = {} # id(batches) -> (groups, indirect buffer, base record, multi draw mode)
 
+		self.setDataVbo(data_vbo)
+
+		# the index buffers can change type (eg. QuadIndexVbo, IndexVbo.optimize)
+		if indices_vbo is not None:
+			indices_vbo.addListener(self)
 
 
-	def _getMaterialBinder(self, shader, material):
-		t = (material,shader)
-		try:
-			mb = self._mbinder_cache[t]
-		except:
-			mb = self._mbinder_cache[t] = material.toCompiled(shader)
 
-		return mb
+	# replaces the DataVbo of the object. The batches refer to the vao of the old one,
+	# so they must be added again
+	def setDataVbo(self, data_vbo):
+		if data_vbo is self._data_vbo:
+			return
+
+		self._data_vbo = data_vbo
+		self.invalidateBounds()
+
+
+	def _getMaterialBinder(self, shader, material):
+		return self._mbinder_cache.get((material, shader), lambda: material.toCompiled(shader))
 
 
 	def _getVao(self, shader, data_vbo):
+		if self._shared_vaos:
+			info = data_vbo.getShaderAttributesFormat(shader)
+			return self._vao_cache.get((shader,), lambda: FormatVao(shader, data_vbo), info)
+
+		# the attribute locations are part of the key in case the shader is relinked
 		info = data_vbo.getShaderAttributesInfo(shader)
-		try:
-			vao = self._vao_cache[info]
-		except:
-			vao = self._vao_cache[info] = Vao(shader, data_vbo)
+		return self._vao_cache.get((shader, data_vbo), lambda: Vao(shader, data_vbo), info[1:])
+
+
+	# the VAO of the batches drawn with hardware instancing. It's a separate one with
+	# the attributes of the current instance VBO too, so that the VAOs of the other
+	# draws don't get them
+	def _getInstancedVao(self, shader, data_vbo):
+		instance_vbo = self._instance_vbo
+
+		def factory(vao_class):
+			vao = vao_class(shader, data_vbo)
+			self._setupInstanceAttributes(vao, shader)
+			return vao
+
+		if self._shared_vaos:
+			info = data_vbo.getShaderAttributesFormat(shader)
+			return self._vao_cache.get((shader, instance_vbo), lambda: factory(FormatVao), ("instanced",) + tuple(info))
+
+		info = data_vbo.getShaderAttributesInfo(shader)
+		return self._vao_cache.get((shader, data_vbo, instance_vbo), lambda: factory(Vao), ("instanced",) + tuple(info[1:]))
+
+
+	# with shared VAOs (requires ARB_vertex_attrib_binding), the meshes with the same
+	# fields share a VAO and only their vertex buffers are bound when drawing. Applies
+	# to the batches added afterwards. Returns whether they are enabled
+	@classmethod
+	def setSharedVaos(cls, enabled=True):
+		ObjManager._shared_vaos = bool(enabled) and bool(glVertexAttribBinding)
+		return ObjManager._shared_vaos
+
 
-		return vao
+	@classmethod
+	def clearCache(cls):
+		cls._vao_cache.clear()
+		cls._mbinder_cache.clear()
 
 
-	def clearCache(self):
-		self._vao_cache = {}
-		self._mbinder_cache = {}
+	@classmethod
+	def setCacheSizes(cls, max_vaos, max_mbinders):
+		cls._vao_cache.setMaxSize(max_vaos)
+		cls._mbinder_cache.setMaxSize(max_mbinders)
+
+
+	# returns (vao stats, material binder stats), see ObjectCache.Stats
+	@classmethod
+	def getCacheStats(cls):
+		return cls._vao_cache.stats(), cls._mbinder_cache.stats()
 
 
 	def addBatch(self, shader, material, first_index, total_primitives, primitive_type = GL_TRIANGLES ):
-		
+		self._batches.append(self._makeBatch(shader, material, first_index, total_primitives, primitive_type))
+		self._batches.sort(key=self._batchKey)
+		self._draw_groups = {}
+		self.invalidateBounds()
+
+
+	# batches are sorted by state, the most expensive to change first. Comparing
+	# the namedtuples would compare the ctypes offsets
+	@staticmethod
+	def _batchKey(batch):
+		return (id(batch.shader), id(batch.vao), id(batch.mbinder), batch.primitive_type, batch.data_type, batch.first_index)
+
+
+	def _makeBatch(self, shader, material, first_index, total_primitives, primitive_type):
 		ppp = self._points_per_primitive[primitive_type]
 	
 		dtype = self._indices_vbo.getDataType()
@@ -101,7 +214,7 @@ class ObjManager(object):
 
 		ofs = first_index * dtype.bytes
 
-		self._batches.append(self.Batch(
+		return self.Batch(
 				shader = shader,
 				mbinder = mbinder,
 				vao = vao,
@@ -109,13 +222,275 @@ class ObjManager(object):
 				total_points = total_primitives * ppp[0] + ppp[1],
 				data_type = dtype.asGlType(),
 				offset = ctypes.c_void_p(ofs),
-			))
+				first_index = first_index,
+			)
 
-		self._batches.sort()
+
+	# called when the type of the indices changes, which changes the offsets
+	def indicesChanged(self, indices_vbo):
+		dtype = indices_vbo.getDataType()
+
+		def rebuild(batches):
+			return sorted((b._replace(
+					data_type = dtype.asGlType(),
+					offset = ctypes.c_void_p(b.first_index * dtype.bytes),
+				) for b in batches), key=self._batchKey)
+
+		self._batches = rebuild(self._batches)
+		self._lod_batches = [rebuild(batches) for batches in self._lod_batches]
+		self._draw_groups = {}
+		self.invalidateBounds()
 
 
 	def clearBatches(self):
 		self._batches = []
+		self._lod_sizes = []
+		self._lod_batches = []
+		self._draw_groups = {}
+		self.invalidateBounds()
+
+
+	# adds a batch drawn instead of the ones added with addBatch when the object is
+	# smaller than max_size on screen (the diameter of its bounding sphere over the
+	# height of the viewport). Only the batches of the smallest max_size above the
+	# size of the object are drawn
+	def addLodBatch(self, max_size, shader, material, first_index, total_primitives, primitive_type = GL_TRIANGLES):
+		i = bisect.bisect_left(self._lod_sizes, max_size)
+		if i == len(self._lod_sizes) or self._lod_sizes[i] != max_size:
+			self._lod_sizes.insert(i, max_size)
+			self._lod_batches.insert(i, [])
+
+		self._lod_batches[i].append(self._makeBatch(shader, material, first_index, total_primitives, primitive_type))
+		self._lod_batches[i].sort(key=self._batchKey)
+		self._draw_groups = {}
+		self.invalidateBounds()
+
+
+	# adds the levels returned by lod.buildLodChain, levels[i] being used below
+	# max_sizes[i]
+	def addLodChain(self, shader, material, levels, max_sizes):
+		for level, max_size in zip(levels, max_sizes):
+			self.addLodBatch(max_size, shader, material, level.first_index, level.total_primitives)
+
+
+	# returns (center, radius), computed from the position field of the vertices
+	# indexed by the batches (LOD ones included) unless set with setBoundingSphere
+	def getBoundingSphere(self):
+		if self._bounding_sphere is None or self._boundsOutdated():
+			self._computeBounds()
+
+		return self._bounding_sphere
+
+
+	# returns (min corner, max corner)
+	def getBoundingBox(self):
+		if self._bounding_box is None or self._boundsOutdated():
+			if self._bounding_sphere is None or self._boundsOutdated():
+				self._computeBounds()
+			else:
+				center, radius = self._bounding_sphere
+				self._bounding_box = (center - radius, center + radius)
+
+		return self._bounding_box
+
+
+	# whether the records changed since the bounds were computed
+	def _boundsOutdated(self):
+		return not self._bounds_set and self._bounds_version != self._data_vbo.getDataVersion()
+
+
+	def _computeBounds(self):
+		self._bounds_version = self._data_vbo.getDataVersion()
+
+		indices = self._indices_vbo.getBuffer().reshape(-1)
+		ranges = [indices[b.first_index:b.first_index + b.total_points] for b in self._batches]
+		for batches in self._lod_batches:
+			ranges += [indices[b.first_index:b.first_index + b.total_points] for b in batches]
+
+		used = N.unique(N.concatenate(ranges)) if ranges else N.zeros(0, dtype="u4")
+
+		pos = self._data_vbo.getSlice("position")[used].astype("f8")
+		if not len(pos): # nothing is drawn
+			origin = N.zeros(pos.shape[1], dtype="f8")
+			self._bounding_sphere = (origin, 0.0)
+			self._bounding_box = (origin, origin)
+			return
+
+		lo, hi = pos.min(axis=0), pos.max(axis=0)
+		center = (lo + hi) * 0.5
+		radius = N.sqrt(((pos - center) ** 2).sum(axis=1).max())
+
+		self._bounding_sphere = (center, radius)
+		self._bounding_box = (lo, hi)
+
+
+	# also sets the bounding box, to the box around the sphere
+	def setBoundingSphere(self, center, radius):
+		self._bounding_sphere = (N.asarray(center, dtype="f8"), float(radius))
+		self._bounding_box = None
+		self._bounds_set = True
+
+
+	# forgets the computed bounds, recomputed when next needed. Called when the
+	# batches or the DataVbo change (changes of the records are found through the
+	# data version of the DataVbo). Bounds set with setBoundingSphere are kept
+	def invalidateBounds(self):
+		if not self._bounds_set:
+			self._bounding_sphere = None
+			self._bounding_box = None
+
+
+	# whether the bounds are known or can be computed (eg. not for a Text without text)
+	def hasBounds(self):
+		if self._bounding_sphere is not None:
+			return True
+
+		return self._data_vbo is not None and self._data_vbo.hasField("position")
+
+
+	# the frustum culling test, when enabled. Doesn't require a GL context
+	@classmethod
+	def setFrustumCulling(cls, enabled=True):
+		ObjManager._culling = bool(enabled)
+
+
+	# whether the object may be visible with the current transform of the scene: its
+	# bounds are tested against the frustum in object space. Objects without bounds are
+	# always visible
+	def isVisible(self, scene):
+		if not self.hasBounds():
+			return True
+
+		planes = frustumPlanes(N.dot(scene.getProjectionMatrix(), scene.getModelViewMatrix()))
+
+		center, radius = self.getBoundingSphere()
+		if not spheresInFrustum(planes, center, radius)[0]:
+			return False
+
+		lo, hi = self.getBoundingBox()
+		return boxesInFrustum(planes, lo, hi)[0]
+
+
+	# the managers which may be visible with the current transform of the scene (and
+	# their own transform), in the same order. Their bounds are tested against the
+	# frustum all at once, instead of one isVisible per object. Objects without bounds
+	# are always visible
+	@classmethod
+	def cullObjects(cls, scene, managers):
+		bounded = [i for i, m in enumerate(managers) if m.hasBounds()]
+		if not bounded:
+			return list(managers)
+
+		planes = frustumPlanes(N.dot(scene.getProjectionMatrix(), scene.getModelViewMatrix()))
+
+		n = len(bounded)
+		matrices = N.empty((n, 4, 4))
+		centers = N.zeros((n, 3)) # 2d positions are at z=0
+		radii = N.empty(n)
+		mins = N.zeros((n, 3))
+		maxs = N.zeros((n, 3))
+
+		for j, i in enumerate(bounded):
+			m = managers[i]
+			matrices[j] = m._transform if m._transform is not None else cls._identity
+			center, radii[j] = m.getBoundingSphere()
+			centers[j,:min(center.size, 3)] = center[:3]
+			lo, hi = m.getBoundingBox()
+			mins[j,:min(lo.size, 3)] = lo[:3]
+			maxs[j,:min(hi.size, 3)] = hi[:3]
+
+		visible = spheresInFrustum(planes, *transformSpheres(matrices, centers, radii))
+
+		# the boxes of the spheres that passed
+		s = N.flatnonzero(visible)
+		if s.size:
+			visible[s] = boxesInFrustum(planes, *transformBoxes(matrices[s], mins[s], maxs[s]))
+
+		culled = set(i for i, v in zip(bounded, visible) if not v)
+		return [m for i, m in enumerate(managers) if i not in culled]
+
+
+	# submits the managers to a renderqueue.RenderQueue with the current transform of
+	# the scene. With frustum culling enabled, they are culled with cullObjects
+	@classmethod
+	def submitObjects(cls, queue, scene, managers):
+		if cls._culling:
+			managers = cls.cullObjects(scene, managers)
+
+		for m in managers:
+			m.submit(queue, scene, cull=False)
+
+
+	# draws the managers with the current transform of the scene. With frustum culling
+	# enabled, they are culled with cullObjects
+	@classmethod
+	def drawObjects(cls, scene, managers):
+		if cls._culling:
+			managers = cls.cullObjects(scene, managers)
+
+		for m in managers:
+			m.draw(scene, cull=False)
+
+
+	# the instances (see drawMany) which may be visible
+	def cullInstances(self, scene, instances):
+		if not instances or not self.hasBounds():
+			return instances
+
+		planes = frustumPlanes(N.dot(scene.getProjectionMatrix(), scene.getModelViewMatrix()))
+
+		center, radius = self.getBoundingSphere()
+		centers, radii = transformSpheres([inst.transform for inst in instances], center, radius)
+		visible = spheresInFrustum(planes, centers, radii)
+
+		return [inst for inst, v in zip(instances, visible) if v]
+
+
+	# the size of the object on screen with the current transform of the scene
+	def getProjectedSize(self, scene):
+		center, radius = self.getBoundingSphere()
+
+		mv = scene.getModelViewMatrix()
+		p = scene.getProjectionMatrix()
+
+		c = self._viewCenter(mv, center)
+
+		w = abs(N.dot(p[3,:3], c) + p[3,3])
+		if w < 1e-9:
+			return float("inf")
+
+		scale = N.sqrt((mv[:3,:3] ** 2).sum(axis=0)).max()
+
+		return radius * scale * abs(p[1,1]) / w
+
+
+	# the center of the bounding sphere in view space
+	@staticmethod
+	def _viewCenter(mv, center):
+		c = N.zeros(3)
+		c[:min(center.size, 3)] = center[:3] # 2d positions are at z=0
+		return N.dot(mv[:3,:3], c) + mv[:3,3]
+
+
+	# the distance along the view direction to the center of the object with the current
+	# transform of the scene. 0 for objects without a bounding sphere
+	def getViewDepth(self, scene):
+		if not self.hasBounds():
+			return 0.0
+
+		center, radius = self.getBoundingSphere()
+		return -self._viewCenter(scene.getModelViewMatrix(), center)[2]
+
+
+	def _selectBatches(self, scene):
+		if not self._lod_sizes:
+			return self._batches
+
+		i = bisect.bisect_right(self._lod_sizes, self.getProjectedSize(scene))
+		if i == len(self._lod_sizes):
+			return self._batches
+
+		return self._lod_batches[i]
 
 
 	def setTransform(self, transform):
@@ -126,29 +501,308 @@ class ObjManager(object):
 		self._transform = None
 
 
+	def getTransform(self):
+		return self._transform
+
+
+	def _drawBatch(self, batch, base_record):
+		if base_record:
+			glDrawElementsBaseVertex(batch.primitive_type, batch.total_points, batch.data_type, batch.offset, base_record)
+		else:
+			glDrawElements(batch.primitive_type, batch.total_points, batch.data_type, batch.offset)
+
+
+	def _drawBatchInstanced(self, batch, base_record, total_instances):
+		if base_record:
+			glDrawElementsInstancedBaseVertex(batch.primitive_type, batch.total_points, batch.data_type, batch.offset, total_instances, base_record)
+		else:
+			glDrawElementsInstanced(batch.primitive_type, batch.total_points, batch.data_type, batch.offset, total_instances)
+
+
+	# adds the batches to a renderqueue.RenderQueue, to be drawn with those of other
+	# objects when it's flushed, with the current transform of the scene. cull=False
+	# skips the frustum culling test (eg. already done by cullObjects)
+	def submit(self, queue, scene, cull=True):
+		if self._transform is not None:
+			scene.pushTransform(self._transform)
+
+		if cull and self._culling and not self.isVisible(scene):
+			batches = []
+		else:
+			batches = self._selectBatches(scene)
+
+		if batches:
+			self._data_vbo.flush()
+
+			base_record = self._data_vbo.getBaseRecord()
+			model_m = scene.getModelMatrix().copy()
+			depth = self.getViewDepth(scene)
+
+			for batch in batches:
+				queue.add(self, batch, model_m, depth, base_record)
+
+		if self._transform is not None:
+			scene.popTransform()
+
+
+	# the batches drawn with a shader that has an instance_m attribute (mat4, the
+	# transform of each instance) are drawn with hardware instancing. The shader can
+	# also have an instance_color attribute (vec4), from the optional color attribute of
+	# the instances (white when missing or None)
+	@classmethod
+	def _canInstance(cls, shader):
+		if cls._instancing is None:
+			ObjManager._instancing = bool(glDrawElementsInstanced) and bool(glVertexAttribDivisor)
+
+		return cls._instancing and shader.hasAttrib("instance_m")
+
+
+	# writes the transforms and colors of the instances to the instance VBO, which
+	# grows as needed
+	@classmethod
+	def _uploadInstances(cls, instances):
+		n = len(instances)
+
+		vbo = cls._instance_vbo
+		if vbo is None or vbo.getTotalRecords() < n:
+			capacity = max(n, 2 * vbo.getTotalRecords() if vbo is not None else 64)
+			vbo = ObjManager._instance_vbo = DataVbo(N.zeros(capacity, dtype=cls._instance_dtype), GL_STREAM_DRAW, DataVbo.STREAM_ORPHAN)
+			vbo.defineFields(("instance_m", 4), ("instance_color", 4))
+
+		records = vbo.getRecords()
+
+		# GLSL matrix attributes take a column per location
+		records["instance_m"][:n] = N.array([inst.transform for inst in instances], dtype="f4").transpose(0, 2, 1).reshape(n, 16)
+
+		colors = [getattr(inst, "color", None) for inst in instances]
+		records["instance_color"][:n] = [c if c is not None else (1.0, 1.0, 1.0, 1.0) for c in colors]
+
+		vbo.markDirty(0, n)
+		vbo.flush()
+
+
+	# points the instance attributes of vao to the instance VBO
+	@classmethod
+	def _setupInstanceAttributes(cls, vao, shader):
+		vbo = cls._instance_vbo
+
+		vao.bind()
+
+		attribs = [(shader.getAttribPos("instance_m") + c, c * 16) for c in xrange(4)]
+		if shader.hasAttrib("instance_color"):
+			attribs.append((shader.getAttribPos("instance_color"), 64))
+
+		stride = cls._instance_dtype.itemsize
+
+		if isinstance(vao, FormatVao):
+			# binding point 0 holds the vertices
+			for loc, offset in attribs:
+				glEnableVertexAttribArray(loc)
+				glVertexAttribFormat(loc, 4, GL_FLOAT, GL_FALSE, offset)
+				glVertexAttribBinding(loc, 1)
+			glVertexBindingDivisor(1, 1)
+			vbo.bindVertexBuffer(1)
+		else:
+			vbo.bind()
+			for loc, offset in attribs:
+				glEnableVertexAttribArray(loc)
+				glVertexAttribPointer(loc, 4, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+				glVertexAttribDivisor(loc, 1)
+
+		Vao.unbind()
+
+
+	# replaces the transform of the instance and uploads the uniforms of the scene,
+	# unless they were last uploaded (last) for the same shader and transform.
+	# Returns what was last uploaded
+	@staticmethod
+	def _uploadInstanceUniforms(scene, shader, transform, last):
+		if last is not None and last[0] is shader and last[1] is transform:
+			return last
+
+		scene.replaceLastTransform(transform)
+		scene.uploadUniforms(shader)
+		return (shader, transform)
+
+
+	# with a multi draw mode, draw() takes a single call for each group of consecutive
+	# batches with the same shader, VAO, material, primitive type and index type.
+	# MULTI_DRAW_INDIRECT keeps the draw commands in a GPU buffer. Falls back to
+	# MULTI_DRAW, or to a call per batch (mode None), when not supported. Returns the
+	# mode set
+	@classmethod
+	def setMultiDraw(cls, mode=MULTI_DRAW_INDIRECT):
+		if mode == cls.MULTI_DRAW_INDIRECT and not bool(glMultiDrawElementsIndirect):
+			mode = cls.MULTI_DRAW
+		if mode == cls.MULTI_DRAW and not (bool(glMultiDrawElements) and bool(glMultiDrawElementsBaseVertex)):
+			mode = None
+
+		ObjManager._multi_draw = mode
+		return mode
+
+
+	# returns the draw groups of the batches and their indirect buffer (or None), built
+	# again only when the batches or the multi draw mode change
+	def _getDrawGroups(self, batches, base_record):
+		mode = self._multi_draw
+
+		try:
+			groups, indirect, base, built_mode = self._draw_groups[id(batches)]
+		except KeyError:
+			pass
+		else:
+			if built_mode != mode: # only MULTI_DRAW_INDIRECT has an indirect buffer
+				del self._draw_groups[id(batches)]
+				return self._getDrawGroups(batches, base_record)
+
+			if base != base_record: # the ring streaming modes move the vertices every frame
+				for g in groups:
+					g.base_vertices[:] = base_record
+
+				if indirect is not None:
+					commands = indirect.getBuffer()
+					commands.view(self._indirect_dtype)["base_vertex"] = base_record
+					indirect.bind()
+					glBufferSubData(GL_DRAW_INDIRECT_BUFFER, 0, commands.nbytes, commands.ctypes.data_as(ctypes.c_void_p))
+
+				self._draw_groups[id(batches)] = (groups, indirect, base_record, mode)
+
+			return groups, indirect
+
+		groups = []
+		commands = N.zeros(len(batches), dtype=self._indirect_dtype)
+
+		first = 0
+		while first < len(batches):
+			b = batches[first]
+			last = first + 1
+			# same shader, mbinder, vao, primitive type and index type
+			while last < len(batches) and batches[last][:4] == b[:4] and batches[last].data_type == b.data_type:
+				last += 1
+
+			group = batches[first:last]
+			total = len(group)
+
+			groups.append(self.DrawGroup(
+					shader = b.shader,
+					mbinder = b.mbinder,
+					vao = b.vao,
+					primitive_type = b.primitive_type,
+					data_type = b.data_type,
+					first_command = first,
+					total_commands = total,
+					counts = N.array([g.total_points for g in group], dtype="i4"),
+					offsets = (ctypes.c_void_p * total)(*[g.offset.value for g in group]),
+					base_vertices = N.zeros(total, dtype="i4") + base_record,
+				))
+
+			commands["count"][first:last] = [g.total_points for g in group]
+			commands["first_index"][first:last] = [g.first_index for g in group]
+
+			first = last
+
+		commands["instance_count"] = 1
+		commands["base_vertex"] = base_record
+
+		indirect = None
+		if mode == self.MULTI_DRAW_INDIRECT and len(commands):
+			indirect = Vbo(GL_DRAW_INDIRECT_BUFFER, commands.size * 5, "uint32", GL_DYNAMIC_DRAW, commands.view("u4"))
+
+		self._draw_groups[id(batches)] = (groups, indirect, base_record, mode)
+
+		return groups, indirect
+
+
+	def _drawGroup(self, group, indirect):
+		if indirect is not None:
+			ofs = group.first_command * self._indirect_dtype.itemsize
+			glMultiDrawElementsIndirect(group.primitive_type, group.data_type, ctypes.c_void_p(ofs), group.total_commands, 0)
+		elif group.base_vertices[0]:
+			glMultiDrawElementsBaseVertex(group.primitive_type, group.counts, group.data_type, group.offsets, group.total_commands, group.base_vertices)
+		else:
+			glMultiDrawElements(group.primitive_type, group.counts, group.data_type, group.offsets, group.total_commands)
+
+
+	# draws the batches once per instance. Instances have a transform and binders, a
+	# list with a material binder per batch (or None to use the batch's ones). The
+	# batches whose shader supports it (see _canInstance) take a draw call per material
+	# binder, the others one per instance
 	def drawMany(self, scene, instances):
 
 		shader = None
 		mbinder = None
 		vao = None
 
+		if self._culling and self._batches:
+			instances = self.cullInstances(scene, instances)
+
+		if not self._batches or not instances:
+			return
+
+		self._data_vbo.flush()
+
+		base_record = self._data_vbo.getBaseRecord()
+
+		# the instance VBO is shared, so the upload of all the instances is only
+		# valid until another group of instances is uploaded
+		uploaded = None
+
+		uniforms = None # (shader, transform) of the last upload of the uniforms
+
 		scene.pushTransform()
 
 		for b_num, batch in enumerate(self._batches):
+			instanced = self._canInstance(batch.shader)
+
 			if batch.shader != shader:
 				shader = batch.shader
 				shader.use()
-				scene.uploadUniforms(shader)
 				vao = None # TODO: required??
 				mbinder = None
 
+			batch_mbinder = batch.mbinder
+
+			if instanced:
+				# the instance transforms are applied in the shader
+				uniforms = self._uploadInstanceUniforms(scene, shader, self._identity, uniforms)
+
+				# instances grouped by material binder, in order of first use
+				groups = {}
+				order = []
+				for inst in instances:
+					b = inst.binders[b_num] if inst.binders is not None else batch_mbinder
+					if b not in groups:
+						groups[b] = []
+						order.append(b)
+					groups[b].append(inst)
+
+				for b in order:
+					group = groups[b]
+					if len(order) > 1 or uploaded is not instances:
+						self._uploadInstances(group)
+						uploaded = instances if len(order) == 1 else None
+
+					# the instance VBO may have been replaced by a larger one
+					instanced_vao = self._getInstancedVao(shader, self._data_vbo)
+					if instanced_vao != vao:
+						vao = instanced_vao
+						vao.bind()
+						vao.bindVertexBuffer(self._data_vbo)
+						self._indices_vbo.bind()
+
+					if b != mbinder:
+						mbinder = b
+						mbinder()
+
+					self._drawBatchInstanced(batch, base_record, len(group))
+
+				continue
+
 			if batch.vao != vao:
 				vao = batch.vao
 				vao.bind()
-
-			batch_mbinder = batch.mbinder
-
-			self._indices_vbo.bind()
+				vao.bindVertexBuffer(self._data_vbo)
+				self._indices_vbo.bind()
 
 			for inst in instances:
 				if inst.binders is not None:
@@ -160,13 +814,14 @@ class ObjManager(object):
 					mbinder = new_mbinder
 					mbinder()
 
-				scene.replaceLastTransform(inst.transform)
-				glDrawElements(batch.primitive_type, batch.total_points, batch.data_type, batch.offset)
+				uniforms = self._uploadInstanceUniforms(scene, shader, inst.transform, uniforms)
+				self._drawBatch(batch, base_record)
 
 		scene.popTransform()
 
 
-	def draw(self, scene):
+	# cull=False skips the frustum culling test (eg. already done by cullObjects)
+	def draw(self, scene, cull=True):
 
 		if self._transform is not None:
 			scene.pushTransform(self._transform)
@@ -175,7 +830,25 @@ class ObjManager(object):
 		mbinder = None
 		vao = None
 
-		for batch in self._batches:
+		if cull and self._culling and not self.isVisible(scene):
+			batches = []
+		else:
+			batches = self._selectBatches(scene)
+
+		if batches:
+			self._data_vbo.flush()
+
+		base_record = self._data_vbo.getBaseRecord() if batches else 0
+
+		# either batches or DrawGroups
+		items = batches
+		indirect = None
+		if self._multi_draw is not None and batches:
+			items, indirect = self._getDrawGroups(batches, base_record)
+			if indirect is not None:
+				indirect.bind()
+
+		for batch in items:
 			if batch.shader != shader:
 				shader = batch.shader
 				shader.use()
@@ -186,13 +859,18 @@ class ObjManager(object):
 			if batch.vao != vao:
 				vao = batch.vao
 				vao.bind()
+				vao.bindVertexBuffer(self._data_vbo)
+				# the index buffer binding is part of the VAO
+				self._indices_vbo.bind()
 
 			if batch.mbinder != mbinder:
 				mbinder = batch.mbinder
 				mbinder()
 
-			self._indices_vbo.bind()
-			glDrawElements(batch.primitive_type, batch.total_points, batch.data_type, batch.offset)
+			if items is not batches:
+				self._drawGroup(batch, indirect)
+			else:
+				self._drawBatch(batch, base_record)
 
 		if self._transform is not None:
 			scene.popTransform()
@@ -0,0 +1,316 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Occlusion culling with hardware occlusion queries: the bounding boxes of objects
+# hidden in the last frames are drawn (without writing color or depth) inside
+# GL_ANY_SAMPLES_PASSED queries after the visible objects, and the objects are drawn
+# again once their box turns out visible. The results are read a frame later, when
+# they are available, so the GPU is never waited for. Visible objects are only queried
+# again every few frames (temporal coherence). With a bvh.BoundingVolumeTree, whole
+# hidden subtrees are skipped with a single query (as in Coherent Hierarchical
+# Culling). The state of a node is dropped when the leaves under it change (see
+# BoundingVolumeTree.getStamp): a moving object only resets its ancestors.
+#
+# The state of the objects and nodes not drawn for forget_after frames is dropped,
+# along with the references to them
+
+
+from glcompat import *
+import numpy as N
+from vbo import DataVbo, IndexVbo
+from vao import Vao
+from culling import frustumPlanes, boxesInFrustum
+
+
+class OcclusionCuller(object):
+
+	# the corners of the unit cube, and its triangles (counter clockwise, outwards)
+	_cube_vertices = [
+			(0,0,0), (1,0,0), (1,1,0), (0,1,0),
+			(0,0,1), (1,0,1), (1,1,1), (0,1,1),
+		]
+
+	_cube_indices = [
+			0,2,1, 0,3,2, # z = 0
+			4,5,6, 4,6,7, # z = 1
+			0,1,5, 0,5,4, # y = 0
+			3,6,2, 3,7,6, # y = 1
+			0,4,7, 0,7,3, # x = 0
+			1,2,6, 1,6,5, # x = 1
+		]
+
+
+	# visible objects are queried again every visible_interval frames. shader is the
+	# program to draw the boxes with: the occlusion_box shaders by default
+	def __init__(self, visible_interval=4, shader=None, forget_after=60):
+		self._visible_interval = visible_interval
+		self._forget_after = forget_after
+		self._shader = shader
+
+		self._frame = 0
+		self._visible = {} # key -> whether it was visible the last time it was known
+		self._pending = {} # key -> query, issued in a previous frame
+		self._queried = {} # key -> frame of the last query
+		self._seen = {} # key -> frame it was last drawn (or tested)
+		self._queue = [] # (key, lo, hi, modelview_m) to be queried in flush()
+		self._free_queries = []
+
+		self._data_vbo = None # the cube, created with the shader
+
+
+	def _setup(self):
+		if self._shader is None:
+			from resources import loadShader
+			from shader import ShaderProgram
+
+			self._shader = ShaderProgram("occlusion_box",
+					[loadShader("occlusion_box_v.shdr"), loadShader("occlusion_box_f.shdr")],
+					uniforms = ["modelview_m", "projection_m", "box_lo", "box_hi"],
+					attribs = ["position"])
+
+		self._data_vbo = DataVbo(N.array(self._cube_vertices, dtype=N.float32))
+		self._data_vbo.defineFields(("position", 3))
+		self._indices_vbo = IndexVbo(self._cube_indices)
+		self._vao = Vao(self._shader, self._data_vbo)
+
+
+	# reads the results of the queries issued in previous frames that are available,
+	# without waiting for the others. To be called at the start of each frame
+	def beginFrame(self):
+		self._frame += 1
+
+		if self._frame % self._forget_after == 0:
+			self._forgetUnseen()
+
+		for key, query in self._pending.items():
+			if not glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE):
+				continue
+
+			visible = bool(glGetQueryObjectuiv(query, GL_QUERY_RESULT))
+			del self._pending[key]
+			self._free_queries.append(query)
+
+			self._setVisible(key, visible)
+
+
+	def _setVisible(self, key, visible):
+		was_visible = self._visible.get(key, True)
+		self._visible[key] = visible
+
+		# tree nodes: hidden nodes whose sibling is hidden make their parent hidden, and
+		# visible nodes make their children visible, to be refined by their own queries
+		if not isinstance(key, tuple):
+			return
+
+		tree, node, stamp = key
+		if stamp != tree.getStamp(node): # the node changed since it was queried
+			return
+
+		if visible and not was_visible and not tree.isLeaf(node):
+			for child in tree.getChildren(node):
+				self._visible[self._nodeKey(tree, child)] = True
+		elif not visible:
+			parent = tree.getParent(node)
+			if parent != -1:
+				c1, c2 = tree.getChildren(parent)
+				sibling = c2 if c1 == node else c1
+				if not self._visible.get(self._nodeKey(tree, sibling), True):
+					self._setVisible(self._nodeKey(tree, parent), False)
+
+
+	@staticmethod
+	def _nodeKey(tree, node):
+		return (tree, node, tree.getStamp(node))
+
+
+	# whether key was visible the last time it was known. Unknown keys are visible
+	def isVisible(self, key):
+		return self._visible.get(key, True)
+
+
+	# queues a query of the box (lo, hi) with the current transform of the scene, if
+	# needed: hidden keys are queried every frame, visible ones every visible_interval
+	# frames, and never while a query of the key is pending
+	def _queueQuery(self, key, lo, hi, scene):
+		if key in self._pending:
+			return
+
+		if self._visible.get(key, True) and self._frame - self._queried.get(key, -self._visible_interval) < self._visible_interval:
+			return
+
+		self._queried[key] = self._frame
+		self._queue.append((key, lo, hi, scene.getModelViewMatrix().copy()))
+
+
+	# the position of the eye with the current transform of the scene
+	@staticmethod
+	def _eyePosition(scene):
+		mv = scene.getModelViewMatrix()
+		return N.linalg.solve(N.asarray(mv[:3,:3], dtype=N.float64), -N.asarray(mv[:3,3], dtype=N.float64))
+
+
+	# whether the eye is in (or too close to) the box, which would be clipped by the
+	# near plane and seem hidden
+	@staticmethod
+	def _inBox(eye, lo, hi):
+		margin = (N.asarray(hi) - lo).max() * 0.01
+		return ((lo - margin) <= eye).all() and (eye <= (hi + margin)).all()
+
+
+	# draws an ObjManager with the current transform of the scene if it's not known to
+	# be hidden, and queries its box when needed
+	def draw(self, scene, obj_manager):
+		if not obj_manager.hasBounds():
+			obj_manager.draw(scene)
+			return
+
+		self._seen[obj_manager] = self._frame
+
+		transform = obj_manager.getTransform()
+		if transform is not None:
+			scene.pushTransform(transform)
+
+		lo, hi = obj_manager.getBoundingBox()
+
+		if not obj_manager.isVisible(scene): # frustum culling
+			visible = False
+		elif self._inBox(self._eyePosition(scene), lo, hi):
+			visible = self._visible[obj_manager] = True
+		else:
+			visible = self.isVisible(obj_manager)
+			self._queueQuery(obj_manager, lo, hi, scene)
+
+		if transform is not None:
+			scene.popTransform()
+
+		if visible:
+			obj_manager.draw(scene)
+
+
+	# draws the objects of a bvh.BoundingVolumeTree (with world space boxes and the
+	# current transform of the scene as the view), front to back, calling
+	# draw_object(obj) for those which may be visible. The hidden subtrees are skipped
+	# and only their root is queried. The nodes are keyed by (tree, node, stamp): when
+	# the leaves under a node change (see BoundingVolumeTree.getStamp) it starts again
+	# as visible, and its old keys are dropped by _forgetUnseen
+	def drawTree(self, scene, tree, draw_object):
+		root = tree.getRoot()
+		if root == -1:
+			return
+
+		mv = scene.getModelViewMatrix()
+		planes = frustumPlanes(N.dot(scene.getProjectionMatrix(), mv))
+		eye = self._eyePosition(scene)
+
+		stack = [root]
+		while stack:
+			node = stack.pop()
+			lo, hi = tree.getBounds(node)
+
+			if not boxesInFrustum(planes, lo, hi)[0]:
+				continue
+
+			key = self._nodeKey(tree, node)
+			leaf = tree.isLeaf(node)
+			self._seen[key] = self._frame
+
+			if self._inBox(eye, lo, hi):
+				self._visible[key] = True
+			else:
+				visible = self.isVisible(key)
+				if leaf or not visible:
+					self._queueQuery(key, lo, hi, scene)
+				if not visible:
+					continue
+
+			if leaf:
+				draw_object(tree.getObject(node))
+				continue
+
+			# the nearest child is drawn first
+			c1, c2 = tree.getChildren(node)
+			d1 = -N.dot(mv[2,:3], sum(tree.getBounds(c1)) * 0.5)
+			d2 = -N.dot(mv[2,:3], sum(tree.getBounds(c2)) * 0.5)
+			stack.extend((c2, c1) if d1 < d2 else (c1, c2))
+
+
+	# issues the queued queries. To be called after drawing the objects of the frame
+	def flush(self, scene):
+		if not self._queue:
+			return
+
+		if self._data_vbo is None:
+			self._setup()
+
+		shader = self._shader
+		shader.use()
+		glUniformMatrix4fv(shader.uni_projection_m, 1, GL_TRUE, N.ascontiguousarray(scene.getProjectionMatrix(), dtype=N.float32).ravel())
+
+		self._vao.bind()
+		self._indices_vbo.bind()
+		dtype = self._indices_vbo.getDataType()
+
+		glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+		glDepthMask(GL_FALSE)
+
+		for key, lo, hi, mv in self._queue:
+			query = self._free_queries.pop() if self._free_queries else glGenQueries(1)
+
+			glUniformMatrix4fv(shader.uni_modelview_m, 1, GL_TRUE, N.ascontiguousarray(mv, dtype=N.float32).ravel())
+			glUniform3fv(shader.uni_box_lo, 1, N.asarray(lo, dtype=N.float32))
+			glUniform3fv(shader.uni_box_hi, 1, N.asarray(hi, dtype=N.float32))
+
+			glBeginQuery(GL_ANY_SAMPLES_PASSED, query)
+			glDrawElements(GL_TRIANGLES, len(self._cube_indices), dtype.asGlType(), None)
+			glEndQuery(GL_ANY_SAMPLES_PASSED)
+
+			self._pending[key] = query
+
+		glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+		glDepthMask(GL_TRUE)
+
+		self._queue = []
+
+
+	# forgets the state of a key (eg. a removed object)
+	def forget(self, key):
+		self._visible.pop(key, None)
+		self._queried.pop(key, None)
+		self._seen.pop(key, None)
+		query = self._pending.pop(key, None)
+		if query is not None:
+			self._free_queries.append(query)
+
+
+	# forgets the keys not drawn in the last forget_after frames, so that the culler
+	# doesn't keep alive the objects and trees no longer drawn, nor the nodes of old
+	# versions of the trees
+	def _forgetUnseen(self):
+		oldest = self._frame - self._forget_after
+		seen = self._seen
+
+		for key in set(seen) | set(self._visible) | set(self._queried) | set(self._pending):
+			if seen.get(key, oldest - 1) < oldest:
+				self.forget(key)
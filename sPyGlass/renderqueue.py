@@ -0,0 +1,165 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from glcompat import *
+from collections import namedtuple
+import numpy as N
+
+
+# Collects the batches of many ObjManagers (see ObjManager.submit) for a frame, and
+# draws them sorted by shader, VAO, material and depth, so each state changes as few
+# times as possible across the objects.
+# The queue doesn't know about the GL state before flush(), so the first batch always
+# sets it up
+class RenderQueue(object):
+
+	Stats = namedtuple("Stats",[
+				"batches",
+				"shader_changes",
+				"vao_changes",
+				"material_changes",
+				"transform_changes",
+			])
+
+	# bits of the sort key, from the most significant
+	_shader_bits = 12
+	_vao_bits = 16
+	_material_bits = 16
+	_depth_bits = 20
+
+
+	# depths are sorted front to back between 0 and max_depth (or back to front, for
+	# transparent objects)
+	def __init__(self, max_depth=1000.0, back_to_front=False):
+		self._max_depth = max_depth
+		self._back_to_front = back_to_front
+		self._stats = self.Stats(0, 0, 0, 0, 0)
+		self.clear()
+
+
+	def clear(self):
+		self._items = [] # (obj_manager, batch, model_m, base_record)
+		self._shaders = []
+		self._vaos = []
+		self._mbinders = []
+		self._depths = []
+
+
+	def __len__(self):
+		return len(self._items)
+
+
+	def add(self, obj_manager, batch, model_m, depth, base_record=0):
+		self._items.append((obj_manager, batch, model_m, base_record))
+		self._shaders.append(batch.shader)
+		self._vaos.append(batch.vao)
+		self._mbinders.append(batch.mbinder)
+		self._depths.append(depth)
+
+
+	# numbers the objects in order of first use, in as many bits
+	@staticmethod
+	def _ranks(objs, bits):
+		ranks = {}
+		r = [ranks.setdefault(id(o), len(ranks)) for o in objs]
+		return N.minimum(N.array(r, dtype=N.uint64), N.uint64((1 << bits) - 1))
+
+
+	def _sortKeys(self):
+		depths = N.clip(N.array(self._depths, dtype="f8") / self._max_depth, 0.0, 1.0)
+		if self._back_to_front:
+			depths = 1.0 - depths
+		depths = (depths * ((1 << self._depth_bits) - 1)).astype(N.uint64)
+
+		keys = self._ranks(self._shaders, self._shader_bits)
+		keys = (keys << N.uint64(self._vao_bits)) | self._ranks(self._vaos, self._vao_bits)
+		keys = (keys << N.uint64(self._material_bits)) | self._ranks(self._mbinders, self._material_bits)
+		keys = (keys << N.uint64(self._depth_bits)) | depths
+
+		return keys
+
+
+	# draws everything in the queue and empties it
+	def flush(self, scene):
+		if not self._items:
+			return
+
+		# stable, so batches with the same key keep the order they were added in
+		order = N.argsort(self._sortKeys(), kind="mergesort")
+
+		shader = None
+		vao = None
+		mbinder = None
+		indices_vbo = None
+		model_m = None
+
+		shader_changes = vao_changes = material_changes = transform_changes = 0
+
+		saved_m = scene.getModelMatrix().copy()
+
+		for i in order:
+			obj, batch, m, base_record = self._items[i]
+
+			if batch.shader is not shader:
+				shader = batch.shader
+				shader.use()
+				shader_changes += 1
+				model_m = None # the uniforms are per program
+				mbinder = None
+
+			if m is not model_m:
+				model_m = m
+				scene.setModelMatrix(m)
+				scene.uploadUniforms(shader)
+				transform_changes += 1
+
+			if batch.vao is not vao:
+				vao = batch.vao
+				vao.bind()
+				vao_changes += 1
+				indices_vbo = None
+
+			# shared VAOs (FormatVao) swap the vertex and index buffers
+			vao.bindVertexBuffer(obj._data_vbo)
+			if obj._indices_vbo is not indices_vbo:
+				indices_vbo = obj._indices_vbo
+				indices_vbo.bind()
+
+			if batch.mbinder is not mbinder:
+				mbinder = batch.mbinder
+				mbinder()
+				material_changes += 1
+
+			obj._drawBatch(batch, base_record)
+
+		scene.setModelMatrix(saved_m)
+
+		self._stats = self.Stats(len(order), shader_changes, vao_changes, material_changes, transform_changes)
+		self.clear()
+
+
+	# the state changes of the last flush
+	def stats(self):
+		return self._stats
@@ -24,73 +24,151 @@ SOFTWARE.
 
 
 from camera import OrthoCamera
-import libs.transformations as T
 import numpy as N
 from glcompat import *
 from mathtools import floatArray
+from vbo import Vbo, DataVbo
 
 class Scene(object):
 
-	def __init__(self):
-		self._model_m_changed = True
+	# the uniform blocks of the shaders (std140, row major matrices):
+	#   FrameUniforms: view_m, projection_m, light_m (mat4) and light0_position (vec4)
+	#   ObjectUniforms: modelview_m (mat4) and normal_m (mat3)
+	# see data/phong_ubo_v.shdr
+	_frame_floats = 52
+	_object_floats = 28 # the rows of a mat3 take a vec4 each
+
+	def __init__(self, max_depth=32):
 		self._camera = None
 		self._default_camera = OrthoCamera()
 		self.setCamera(None)
 
-		self._model_m = T.identity_matrix()
-		self._model_m_stack = [T.identity_matrix()]
+		# the transform stack, written in place. _stack[_depth] is the current transform,
+		# and _changed[i] tells whether level i differs from level i-1
+		self._stack = N.zeros((max_depth, 4, 4), dtype=N.float32)
+		self._stack[0] = N.identity(4)
+		self._changed = [False] * max_depth
+		self._depth = 0
+		self._model_m_changed = True
+
 		self._light_position = floatArray([1000.0, 1000.0, 1000.0])
 
 		# these are computed and cached:
-		self._normal_m = None
-		self._modelview_m = None
+		self._modelview_m = N.identity(4, dtype=N.float32)
+		self._normal_m = N.identity(3, dtype=N.float32)
+		self._normal_m_changed = True
+		self._modelview_version = 0 # increased each time the modelview matrix changes
 		self._light_m = None
 		self._view_m = self._projection_m = None
+
+		# uniform buffers, see enableUniformBuffers
+		self._frame_ubo = None
+		self._object_ubo = None
+
+
+	# makes room for another level in the stack
+	def _grow(self):
+		depth = len(self._stack)
+		if self._depth + 1 < depth:
+			return
+
+		stack = N.zeros((depth * 2, 4, 4), dtype=N.float32)
+		stack[:depth] = self._stack
+		self._stack = stack
+		self._changed += [False] * depth
 		
 
 	def pushTransform(self, add_transform=None):
-		self._model_m_stack.append(self._model_m)
+		self._grow()
+		d = self._depth = self._depth + 1
+
 		if add_transform is not None:
-			self._model_m = N.dot(self._model_m, add_transform)
-			self._model_m_changed = True
+			N.dot(self._stack[d-1], N.asarray(add_transform, dtype=N.float32), out=self._stack[d])
+			self._changed[d] = self._model_m_changed = True
+		else:
+			self._stack[d] = self._stack[d-1]
+			self._changed[d] = False
 		
 
 	def popTransform(self):
-		if len(self._model_m_stack)>1:
-			self._model_m = self._model_m_stack.pop()
+		d = self._depth
+		if d > 0:
+			self._depth = d - 1
+			if self._changed[d]:
+				self._model_m_changed = True
 		else:
-			self._model_m = T.identity_matrix()
-
-		self._model_m_changed = True
+			self._stack[0] = N.identity(4)
+			self._model_m_changed = True
 
 
 	def resetTransform(self):
-		self._model_m = T.identity_matrix()
-		del self._model_m_stack[1:]
+		self._stack[0] = N.identity(4)
+		self._depth = 0
 		self._model_m_changed = True
 
 
 	def replaceLastTransform(self, transform):
-		self._model_m = N.dot(self._model_m_stack[-1], transform)
-		self._model_m_changed = True
+		d = self._depth
+		if d > 0:
+			N.dot(self._stack[d-1], N.asarray(transform, dtype=N.float32), out=self._stack[d])
+		else:
+			self._stack[0] = transform
+		self._changed[d] = self._model_m_changed = True
 
 
-	def _prepareMatrices(self):
+	def _prepareModelView(self):
 		if self._model_m_changed or self._camera_changed:
 			if self._camera_changed:
-				self._view_m, self._projection_m = self._camera.getMatrices()
+				view_m, projection_m = self._camera.getMatrices()
+				self._view_m = N.asarray(view_m, dtype=N.float32)
+				self._projection_m = N.asarray(projection_m, dtype=N.float32)
 				self._camera_changed = False
+				self._frame_ubo_dirty = True
 
 				self._light_m = self._view_m
 
-			self._modelview_m = N.dot(self._view_m, self._model_m)
+			N.dot(self._view_m, self._stack[self._depth], out=self._modelview_m)
 			self._model_m_changed = False
+			self._normal_m_changed = True
+			self._modelview_version += 1
+
+
+	def _prepareMatrices(self):
+		self._prepareModelView()
+
+		if self._normal_m_changed:
+			self._normal_m_changed = False
 
-			m = self._modelview_m[0:3,0:3]
-			try:
-				self._normal_m = N.transpose(N.linalg.inv(m))
-			except:
-				self._normal_m = m
+			# the inverse transpose is the cofactor matrix over the determinant, and the
+			# columns of the cofactor matrix are cross products of the columns
+			cols = self._modelview_m[0:3,0:3].T
+			cofactors = N.cross(cols[[1,2,0]], cols[[2,0,1]])
+			det = N.dot(cols[0], cofactors[0])
+
+			if det != 0.0:
+				N.divide(cofactors.T, det, out=self._normal_m)
+			else:
+				self._normal_m[...] = cols.T
+
+
+	def getModelMatrix(self):
+		return self._stack[self._depth]
+
+
+	# replaces the current transform, keeping the stack
+	def setModelMatrix(self, model_m):
+		self._stack[self._depth] = model_m
+		self._changed[self._depth] = self._model_m_changed = True
+
+
+	def getModelViewMatrix(self):
+		self._prepareModelView()
+		return self._modelview_m
+
+
+	def getProjectionMatrix(self):
+		self._prepareModelView()
+		return self._projection_m
 
 
 	def getCamera(self):
@@ -123,7 +201,74 @@ class Scene(object):
 			self._camera_changed = True
 
 
+	# with uniform buffers, the shaders with the FrameUniforms and ObjectUniforms blocks
+	# get the matrices of the camera from a buffer updated when the camera changes, and
+	# those of each object from a slot of a per frame ring of max_draws slots: a single
+	# write, and no glUniform calls. The objects drawn in a frame (see Vbo.endFrame) with
+	# distinct transforms must not exceed max_draws
+	def enableUniformBuffers(self, max_draws=4096):
+		# the ranges bound must be aligned
+		align = max(int(glGetIntegerv(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT)), 16) // 4
+
+		def aligned(floats):
+			return (floats + align - 1) // align * align
+
+		stream = Vbo.STREAM_PERSISTENT if bool(glBufferStorage) else Vbo.STREAM_RING
+
+		self._frame_ubo = DataVbo(N.zeros((1, aligned(self._frame_floats)), dtype="f4"), GL_DYNAMIC_DRAW, stream)
+		self._object_ubo = DataVbo(N.zeros((max_draws, aligned(self._object_floats)), dtype="f4"), GL_DYNAMIC_DRAW, stream)
+
+		self._frame_ubo_dirty = True
+		self._ubo_frame = None
+		self._object_slot = -1
+		self._slot_version = None # the version of the modelview matrix in the current slot
+
+
+	def _uploadUniformBuffers(self):
+		self._prepareMatrices()
+
+		frame = Vbo.getFrame()
+		if frame != self._ubo_frame:
+			# the slots of the previous frames may be in use
+			self._ubo_frame = frame
+			self._object_slot = -1
+			self._slot_version = None
+			self._frame_ubo_dirty = True
+
+		if self._frame_ubo_dirty:
+			ubo = self._frame_ubo
+			rec = ubo.getBuffer()[0]
+			rec[0:16] = self._view_m.ravel()
+			rec[16:32] = self._projection_m.ravel()
+			rec[32:48] = self._light_m.ravel()
+			rec[48:51] = self._light_position.ravel()
+			ubo.markDirty()
+			ubo.flush()
+
+			# binding points as in ShaderProgram
+			ubo.bindRange(GL_UNIFORM_BUFFER, 0, ubo.getBaseRecord() * rec.nbytes, self._frame_floats * 4)
+			self._frame_ubo_dirty = False
+
+		if self._slot_version != self._modelview_version:
+			ubo = self._object_ubo
+			self._object_slot = (self._object_slot + 1) % ubo.getTotalRecords()
+			self._slot_version = self._modelview_version
+
+			rec = ubo.getBuffer()[self._object_slot]
+			rec[0:16] = self._modelview_m.ravel()
+			rec[16:28].reshape(3, 4)[:,:3] = self._normal_m
+			ubo.markDirty(self._object_slot, self._object_slot + 1)
+			ubo.flush()
+
+			offset = (ubo.getBaseRecord() + self._object_slot) * rec.nbytes
+			ubo.bindRange(GL_UNIFORM_BUFFER, 1, offset, self._object_floats * 4)
+
+
 	def uploadUniforms(self, shader):
+		if self._object_ubo is not None and shader.hasUniformBlock("ObjectUniforms"):
+			self._uploadUniformBuffers()
+			return
+
 		self._prepareMatrices()
 
 		glUniformMatrix4fv(shader.uni_modelview_m,1,GL_TRUE, self._modelview_m.ravel())
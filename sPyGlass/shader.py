@@ -43,6 +43,12 @@ class ShaderProgram:
 	 'color',
 	 'tc']
 
+	# the binding points of the uniform blocks filled by Scene (see
+	# Scene.enableUniformBuffers)
+	_uniformBlockBindings = {
+	 'FrameUniforms': 0,
+	 'ObjectUniforms': 1}
+
 	def __init__(self, name, shaders, uniforms = 'default', attribs = 'default'):
 		self._name = name
 		self._program = glCreateProgram()
@@ -55,6 +61,14 @@ class ShaderProgram:
 		if glGetProgramiv(self._program, GL_LINK_STATUS) != GL_TRUE:
 			raise RuntimeError(glGetProgramInfoLog(self._program))
 		glUseProgram(self._program)
+		self._uniform_blocks = set()
+		if bool(glGetUniformBlockIndex):
+			for block, binding in ShaderProgram._uniformBlockBindings.items():
+				index = glGetUniformBlockIndex(self._program, block)
+				if index != GL_INVALID_INDEX:
+					glUniformBlockBinding(self._program, index, binding)
+					self._uniform_blocks.add(block)
+
 		if uniforms:
 			if uniforms == 'default':
 				uniforms = ShaderProgram._defaultUniforms
@@ -93,6 +107,17 @@ class ShaderProgram:
 				setattr(self, 'attr_' + attrib, loc)
 			return loc
 
+	def hasUniformBlock(self, block):
+		return block in self._uniform_blocks
+
+	# like getAttribPos, without complaining about missing attributes
+	def hasAttrib(self, attrib):
+		try:
+			loc = self._loc_attribs[attrib]
+		except:
+			loc = self._loc_attribs[attrib] = glGetAttribLocation(self._program, attrib)
+		return loc != -1
+
 	def getName(self):
 		return self._name
 
@@ -27,7 +27,7 @@ import zipfile
 import os.path
 import pygame
 import StringIO
-from vbo import DataVbo, IndexVbo
+from vbo import DataVbo, QuadIndexVbo
 from materials import Material
 from texture import Texture
 from objmanager import ObjManager
@@ -35,7 +35,7 @@ import resources as R
 from collections import namedtuple
 import numpy as N
 from mathtools import NumpyDefaultFloatType
-from mem import MemoryManager
+from mem import MemoryManager, BestFitPolicy
 
 try:
 	import xml.etree.ElementTree as ET
@@ -127,32 +127,55 @@ class LitteraFont:
 			
 
 class TextMemoryManager(MemoryManager):
-		def __init__(self, page_size = 4096):
-			super(TextMemoryManager, self).__init__()
-			self._page_size = page_size
+		_unit_bytes = 4 * N.dtype(NumpyDefaultFloatType).itemsize # a vertex: pos(2)+uv(2)
 
-			indices = []
+		# stream is the streaming mode of the pages' DataVbo (see Vbo.STREAM_*)
+		def __init__(self, page_size = 4096, policy = BestFitPolicy, deferred_free = False, stream = None):
+			super(TextMemoryManager, self).__init__(policy, deferred_free)
+			self._page_size = page_size
+			self._stream = stream
 
-			j = 0
-			for i in xrange(2*page_size): # in case a large page is requested
-				indices.extend([j,j+1,j+3,j+1,j+2,j+3])
-				j += 4
+			self._indices_vbo = QuadIndexVbo.getShared()
+			self._indices_vbo.reserve(page_size/4)
+			self._shader = R.loadShaderProgram("text")
 
-			indices = N.array(indices, dtype="u2")
+		def _pageSizeFor(self, min_size):
+			return max(min_size, self._page_size)
 
-			self._indices_vbo = IndexVbo(indices)
-			self._shader = R.loadShaderProgram("text")
 
 		# allocate a page for at least min_size vertices
 		def _allocNewPage(self, min_size):
-			size = max(min_size, self._page_size)
+			size = self._pageSizeFor(min_size)
+			self._indices_vbo.reserve((size+3)/4) # a page larger than usual may be requested
 			data = N.zeros((size,4),dtype=NumpyDefaultFloatType) # pos(2)+uv(2) -> 4
-			data_vbo = DataVbo(data, GL_DYNAMIC_DRAW)
+			data_vbo = DataVbo(data, GL_STREAM_DRAW if self._stream else GL_DYNAMIC_DRAW, self._stream)
 			data_vbo.defineFields(("position",2),("tc",2))
 
 			return data_vbo, size
 
 
+		def _moveData(self, src_page, src_start, dst_page, dst_start, size):
+			self._pages[dst_page].copyRecords(self._pages[src_page], src_start, dst_start, size)
+
+
+		def _insertFence(self):
+			return glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+
+		def _isFenceSignaled(self, fence):
+			# a timeout of 0 just polls the fence, it never blocks
+			return glClientWaitSync(fence, 0, 0) in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED)
+
+
+		def _deleteFence(self, fence):
+			glDeleteSync(fence)
+
+
+		def _waitFence(self, fence):
+			while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000) == GL_TIMEOUT_EXPIRED:
+				pass
+
+
 		def getIndicesVbo(self):
 			return self._indices_vbo
 
@@ -175,6 +198,7 @@ class Text(ObjManager):
 
 		self._data_vbo_mem = None
 		self._data_vbo = None
+		self._total_prims = 0
 
 		super(Text,self).__init__(None, self._mem.getIndicesVbo())
 
@@ -187,21 +211,53 @@ class Text(ObjManager):
 
 
 
+	# replaces the memory manager shared by the Text instances created from now on
+	# eg. Text.setMemoryManager(TextMemoryManager(policy=SegregatedFitPolicy))
+	@classmethod
+	def setMemoryManager(cls, mem):
+		cls._mem = mem
+
+
 	def setFont(self, font):
 		self._font = font
 
 
+	# creates a Text instance per string in texts. Their vertices are allocated together
+	# so they lie in a single range of the same DataVbo: their dirty ranges merge, and
+	# are uploaded with a single call
+	@classmethod
+	def createMany(cls, font, texts, origin_at_base=True):
+		if cls._mem is None:
+			cls._mem = TextMemoryManager()
+
+		blocks = cls._mem.allocMany([max(len(text),1)*4 for text in texts])
+
+		objs = []
+		for block, text in zip(blocks, texts):
+			t = cls(font)
+			block.setOwner(t)
+			t._data_vbo_mem = block
+			t.setDataVbo(block.page_data)
+			t.setText(text, origin_at_base)
+			objs.append(t)
+
+		return objs
+
+
+	# the vertices are uploaded by the first draw of a Text using the same page
 	def setText(self, text, origin_at_base=True):
 
 		txt_size = len(text)
 
-		if self._data_vbo_mem is None or  txt_size > len(self._text): # we need to reallocate
+		if self._data_vbo_mem is None or txt_size*4 > self._data_vbo_mem.size: # we need to reallocate
 			if self._data_vbo_mem:
 				self._data_vbo_mem.free()
 			self._data_vbo_mem = self._mem.alloc(txt_size*4)
-			self._data_vbo = self._data_vbo_mem.page_data
+			self._data_vbo_mem.setOwner(self)
+			self.setDataVbo(self._data_vbo_mem.page_data)
 
 		self._text = text
+		self.invalidateBounds()
 		font = self._font
 		data = self._data_vbo.getBuffer()
 
@@ -262,12 +318,28 @@ class Text(ObjManager):
 
 		self.bounds = pygame.Rect(xmin,ymin,xmax-xmin,ymax-ymin)
 
-		self.clearBatches()
+		self._total_prims = tot_prims
+
 		if i0 != i1:
-			self._data_vbo.updateData(i0, i1)
+			self._data_vbo.markDirty(i0, i1)
+
+		self._updateBatch()
+
+
+	def _updateBatch(self):
+		self.clearBatches()
+		if self._total_prims:
 			# (i0/4)*6 :
 			# 4 vertices per quad, 6 indices per quad (2 triangles)
-			self.addBatch(self._shader, font.getMaterial(), (i0/4)*6, tot_prims)
+			i0 = self._data_vbo_mem.start
+			self.addBatch(self._shader, self._font.getMaterial(), (i0/4)*6, self._total_prims)
+
+
+	# called by the memory manager when our vertices have been relocated
+	def blockMoved(self, block):
+		self.setDataVbo(block.page_data)
+		self.invalidateBounds() # the records may have moved within the same DataVbo
+		self._updateBatch()
 
 
 	def __del__(self):
@@ -26,9 +26,12 @@ SOFTWARE.
 
 
 from glcompat import *
+import weakref
 
 
 class Vao:
+	_bound = None # the last Vao bound with bind()
+
 	def __init__(self, shader=None, data_vbo=None):
 		self._vao = glGenVertexArray()
 		self._info = None
@@ -43,6 +46,7 @@ class Vao:
 		data_vbo.setupShaderAttributes(shader)
 		self._info = data_vbo.getShaderAttributesInfo(shader)
 		glBindVertexArray(0)
+		Vao._bound = None
 
 
 	def isCompatible(self, shader, data_vbo):
@@ -51,6 +55,19 @@ class Vao:
 
 	def bind(self):
 		glBindVertexArray(self._vao)
+		Vao._bound = self
+
+
+	# the data VBO is part of the VAO
+	def bindVertexBuffer(self, data_vbo):
+		pass
+
+
+	# to be used when the VAO binding is changed without bind()
+	@classmethod
+	def unbind(cls):
+		glBindVertexArray(0)
+		Vao._bound = None
 
 
 	def __del__(self):
@@ -61,3 +78,37 @@ class Vao:
 
 
 
+
+
+
+# A VAO with only the formats of the attributes (ARB_vertex_attrib_binding), which can
+# be shared by all the DataVbos with the same fields: they are swapped in with
+# bindVertexBuffer instead of binding another VAO
+class FormatVao(Vao):
+	_data_vbo = None # weak reference to the bound DataVbo
+
+	def setup(self, shader, data_vbo):
+		shader.use()
+		glBindVertexArray(self._vao)
+		data_vbo.setupShaderAttributeFormats(shader)
+		self._info = data_vbo.getShaderAttributesFormat(shader)
+		self._data_vbo = None
+		glBindVertexArray(0)
+		Vao._bound = None
+
+
+	def isCompatible(self, shader, data_vbo):
+		return self._info and self._info == data_vbo.getShaderAttributesFormat(shader)
+
+
+	def bind(self):
+		if Vao._bound is not self:
+			glBindVertexArray(self._vao)
+			Vao._bound = self
+
+
+	# must be called with the VAO bound
+	def bindVertexBuffer(self, data_vbo):
+		if self._data_vbo is None or self._data_vbo() is not data_vbo:
+			data_vbo.bindVertexBuffer()
+			self._data_vbo = weakref.ref(data_vbo)
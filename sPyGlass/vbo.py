@@ -23,18 +23,90 @@ SOFTWARE.
 """
 
 
+import bisect
 import ctypes
-from gltypes import NumberType,MinimalNumberType
+import weakref
+from gltypes import NumberType,MinimalNumberType,AttribTypes,attribTypeName,attribBytes
 from glcompat import *
 import numpy as N
 from mathtools import *
+from meshtools import minimalIndexType, optimizeVertexCache, optimizeVertexFetch, remapVertices
+from cache import invalidateAll
+
+
+
+# adds [start, end) to the sorted, disjoint and non adjacent ranges in starts and ends,
+# merging it with those it overlaps or touches
+def _addRange(starts, ends, start, end):
+	# the ranges [i, j) overlap or touch the new one
+	i = bisect.bisect_left(ends, start)
+	j = bisect.bisect_right(starts, end)
+
+	if i < j:
+		start = min(start, starts[i])
+		end = max(end, ends[j-1])
+
+	starts[i:j] = [start]
+	ends[i:j] = [end]
 
 
 
 class Vbo(object):
-	def __init__(self, target, total_values, data_type, usage = GL_STATIC_DRAW, data=None):
+	# streaming modes, for buffers updated often:
+	#   STREAM_ORPHAN: each update re-specifies the whole storage, so the driver can
+	#     hand out new memory instead of waiting for the GPU to be done with the old one
+	#   STREAM_RING: the storage holds ring_size copies of the data. Each frame the
+	#     updates go to the next copy, so the ones still in use are not touched
+	#   STREAM_PERSISTENT: like STREAM_RING, but the storage is persistently mapped
+	#     (ARB_buffer_storage) and the buffer is a numpy view of the mapped memory, so
+	#     the writes go straight to the GPU and updates need no GL calls
+	# With the ring modes the data of the current frame starts at getBaseRecord() and
+	# Vbo.endFrame() must be called once per frame. With STREAM_PERSISTENT only the
+	# rows marked as written (see DataVbo.markDirty) are carried over to the next
+	# segments, and a segment is only reused once the GPU is done with its frame
+	STREAM_ORPHAN = "orphan"
+	STREAM_RING = "ring"
+	STREAM_PERSISTENT = "persistent"
+
+	_frame = 0
+	_persistent_vbos = weakref.WeakSet()
+
+	@classmethod
+	def endFrame(cls):
+		cls._frame += 1
+		for vbo in list(cls._persistent_vbos):
+			vbo._nextSegment()
+
+
+	@classmethod
+	def getFrame(cls):
+		return cls._frame
+
+
+	def __init__(self, target, total_values, data_type, usage = GL_STATIC_DRAW, data=None, stream=None, ring_size=3):
 		self._vbo = None
+		self._target = target
+		self._usage = usage
+
+		self._stream = stream
+		self._ring_size = ring_size if stream in (self.STREAM_RING, self.STREAM_PERSISTENT) else 1
+		self._segment = 0
+		self._segment_frame = Vbo._frame
+
+		# STREAM_PERSISTENT: rows written in the current frame, as sorted [start, end)
+		# ranges, those of the last ring_size-1 frames, and a fence per segment
+		self._written_starts = []
+		self._written_ends = []
+		self._written = []
+		self._fences = [None] * self._ring_size
+
+		self._vbo = glGenBuffers(1)
+
+		self._setData(total_values, data_type, data)
 
+
+	# (re)creates the storage of the buffer, keeping the same buffer name
+	def _setData(self, total_values, data_type, data=None):
 		self._total_values = total_values
 
 		self._data_type = data_type = NumberType(data_type)
@@ -45,6 +117,9 @@ class Vbo(object):
 
 		if data is not None:
 			self._buffer = toNumpyArray(data, self._numpy_type)
+			if not self._buffer.flags.c_contiguous:
+				# copy once, rather than on every upload
+				self._buffer = N.ascontiguousarray(self._buffer)
 		else:
 			self._buffer = N.zeros(self._total_values, dtype=self._numpy_type)
 
@@ -53,17 +128,90 @@ class Vbo(object):
 
 		dptr = self._buffer.ravel().ctypes.data_as(ctypes.c_void_p)
 
-		self._vbo = glGenBuffers(1)
-
 		#print "Vbo id:",self._vbo
 		#print self._buffer.size, self._total_values, self._bytes_per_item, self._buffer.nbytes
 
-		self._target = target
-
 		self._allocated_bytes = self._total_values * self._bytes_per_item
 
-		glBindBuffer(target, self._vbo)
-		glBufferData(target, self._allocated_bytes, dptr, usage)
+		glBindBuffer(self._target, self._vbo)
+
+		if self._stream == self.STREAM_PERSISTENT:
+			self._mapStorage()
+		elif self._stream == self.STREAM_RING:
+			glBufferData(self._target, self._allocated_bytes * self._ring_size, None, self._usage)
+			glBufferSubData(self._target, 0, self._allocated_bytes, dptr)
+		else:
+			glBufferData(self._target, self._allocated_bytes, dptr, self._usage)
+
+
+	# creates immutable storage for all the segments, maps it for good, and replaces
+	# the host buffer by a view of the first segment
+	def _mapStorage(self):
+		total_bytes = self._allocated_bytes * self._ring_size
+		flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+
+		glBufferStorage(self._target, total_bytes, None, flags)
+		ptr = glMapBufferRange(self._target, 0, total_bytes, flags)
+		if not isinstance(ptr, (int, long)):
+			ptr = ctypes.cast(ptr, ctypes.c_void_p).value
+
+		mapped = N.frombuffer((ctypes.c_ubyte * total_bytes).from_address(ptr), dtype=self._numpy_type)
+		self._mapped = mapped.reshape((self._ring_size,) + self._buffer.shape)
+		self._mapped[:] = self._buffer
+
+		self._buffer = self._mapped[0]
+		Vbo._persistent_vbos.add(self)
+
+
+	# flags rows [start, end) of the host buffer as written in the current frame
+	def _markWritten(self, start, end):
+		_addRange(self._written_starts, self._written_ends, start, end)
+
+
+	# persistent buffers move on to the next segment every frame. It was last used
+	# ring_size frames ago: once the GPU is done with it, it gets the rows written
+	# since then
+	def _nextSegment(self):
+		self._fences[self._segment] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+		self._written.append((self._written_starts, self._written_ends))
+		self._written = self._written[len(self._written) - (self._ring_size - 1):] if self._ring_size > 1 else []
+		self._written_starts = []
+		self._written_ends = []
+
+		prev = self._buffer
+		self._segment = (self._segment + 1) % self._ring_size
+		self._waitSegment(self._segment)
+		self._buffer = self._mapped[self._segment]
+		self._segment_frame = Vbo._frame
+
+		if self._buffer is prev:
+			return
+
+		starts, ends = [], []
+		for frame_starts, frame_ends in self._written:
+			for start, end in zip(frame_starts, frame_ends):
+				_addRange(starts, ends, start, end)
+
+		for start, end in zip(starts, ends):
+			self._buffer[start:end] = prev[start:end]
+
+
+	# waits until the GPU is done with the last frame that used the segment. With
+	# enough segments, it normally is long before
+	def _waitSegment(self, segment):
+		fence = self._fences[segment]
+		if fence is None:
+			return
+
+		self._fences[segment] = None
+		while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000) == GL_TIMEOUT_EXPIRED:
+			pass
+		glDeleteSync(fence)
+
+
+	def getStreamMode(self):
+		return self._stream
 
 
 	# returns a NumberType
@@ -75,10 +223,19 @@ class Vbo(object):
 		glBindBuffer(self._target,self._vbo)
 
 
+	# binds bytes [offset, offset+size) to an indexed target (eg. GL_UNIFORM_BUFFER)
+	def bindRange(self, target, index, offset, size):
+		glBindBufferRange(target, index, self._vbo, offset, size)
+
+
 	def __del__(self):
 		if self._vbo is not None and bool(glDeleteBuffers):
 			glDeleteBuffers(1, GLuint(self._vbo))
 
+		for fence in getattr(self, "_fences", ()):
+			if fence is not None and bool(glDeleteSync):
+				glDeleteSync(fence)
+
 
 	def getBuffer(self):
 		return self._buffer
@@ -86,18 +243,45 @@ class Vbo(object):
 
 
 
+# Listeners (eg. ObjManager) are notified with listener.indicesChanged(vbo) when
+# the type of the indices changes, since that changes the offsets of the batches
 class IndexVbo(Vbo):
-	def __init__(self, data, usage = GL_STATIC_DRAW, force_large_data=False):
-		try:
-			total_indices = int(data)
+	class Error(ValueError):
+		pass
+
+	# wraps buf (see bufferAsArray) without copying it or looking at its values
+	@classmethod
+	def fromBuffer(cls, buf, dtype, usage = GL_STATIC_DRAW):
+		return cls(bufferAsArray(buf, dtype), usage)
+
+
+	# lists of indices are stored with the narrowest type that holds them (uint8,
+	# uint16 or uint32). Numpy arrays keep their type, unless narrow is True
+	def __init__(self, data, usage = GL_STATIC_DRAW, force_large_data=False, narrow=False):
+		self._listeners = weakref.WeakKeyDictionary()
+
+		total_indices = None
+		if not isNumpyArray(data): # a single element array is not a count
+			try:
+				total_indices = int(data)
+			except:
+				pass
+
+		if total_indices is not None:
 			data = None
 			data_type = "uint32" if force_large_data or total_indices > 65536 else "uint16"
-		except:
-			data = toNumpyArray(data, "u4" if force_large_data else "auto")
+		else:
+			if not isNumpyArray(data):
+				data = N.asarray(data)
+				narrow = True
+
+			if force_large_data:
+				data = toNumpyArray(data, N.dtype("u4"))
+			elif narrow:
+				data = self._narrow(data)
+
 			total_indices = data.size
-			data_type = str(data.dtype)
-			if "'" in data_type:
-				data_type = data_type.split("'")[1] # eg: dtype('uint32') -> "uint32"
+			data_type = self._typeName(data.dtype)
 
 		super(IndexVbo,self).__init__(
 								GL_ELEMENT_ARRAY_BUFFER,
@@ -107,6 +291,130 @@ class IndexVbo(Vbo):
 								data)
 
 
+	@staticmethod
+	def _typeName(dtype):
+		data_type = str(dtype)
+		if "'" in data_type:
+			data_type = data_type.split("'")[1] # eg: dtype('uint32') -> "uint32"
+		return data_type
+
+
+	@staticmethod
+	def _narrow(data):
+		t = minimalIndexType(int(data.max()) if data.size else 0)
+		return toNumpyArray(data, t)
+
+
+	def addListener(self, listener):
+		self._listeners[listener] = True
+
+
+	# replaces all the indices, notifying the listeners if their type changes
+	def _setIndices(self, data):
+		old_type = self._numpy_type
+
+		self._setData(data.size, self._typeName(data.dtype), data)
+
+		if self._numpy_type != old_type:
+			for listener in self._listeners.keys():
+				listener.indicesChanged(self)
+
+
+	# appends each array of indices at the end of the buffer (keeping the type of the
+	# indices, so they must fit in it). Returns the first index of each
+	def appendIndices(self, arrays):
+		old = self._buffer.ravel()
+
+		firsts = []
+		total = old.size
+		for a in arrays:
+			firsts.append(total)
+			total += len(a)
+
+		self._setIndices(N.concatenate([old] + [N.asarray(a, dtype=old.dtype).ravel() for a in arrays]))
+
+		return firsts
+
+
+	# reorders the triangles (GL_TRIANGLES only) for the post-transform vertex cache and,
+	# if reorder_vertices is True, renumbers the vertices in order of first use. Then
+	# stores the indices with the narrowest type.
+	# ranges, a list of (first_index, total_indices), restricts the triangle reordering
+	# to each range (eg. the batches using the buffer), so triangles don't move from one
+	# range to another.
+	# Returns the remap (see meshtools.optimizeVertexFetch) to apply to the vertex data,
+	# eg. with DataVbo.remapRecords, or None if the vertices were not renumbered.
+	# total_vertices must be the number of records of the vertex data: it defaults to
+	# the highest index + 1, or, if the DataVbo is given, to its number of records, and
+	# then the remap is also applied to it
+	def optimize(self, total_vertices=None, cache_size=32, reorder_vertices=True, ranges=None, data_vbo=None):
+		indices = self._buffer.ravel().astype("u4")
+
+		if data_vbo is not None:
+			total_vertices = data_vbo.getTotalRecords()
+		elif total_vertices is None:
+			total_vertices = int(indices.max()) + 1 if indices.size else 0
+
+		if indices.size and int(indices.max()) >= total_vertices:
+			raise self.Error("Index %s is out of the %s vertices"%(indices.max(), total_vertices))
+
+		for first, count in ranges or [(0, indices.size)]:
+			indices[first:first+count] = optimizeVertexCache(indices[first:first+count], total_vertices, cache_size)
+
+		remap = None
+		if reorder_vertices:
+			indices, remap = optimizeVertexFetch(indices, total_vertices)
+
+		self._setIndices(self._narrow(indices))
+
+		if remap is not None and data_vbo is not None:
+			data_vbo.remapRecords(remap)
+
+		return remap
+
+
+
+# An index buffer for drawing quads as pairs of triangles: quad q uses the vertices
+# 4q..4q+3. It grows (doubling) on demand with reserve(), switching from uint16 to
+# uint32 indices when needed (which the listeners are notified of)
+class QuadIndexVbo(IndexVbo):
+	_shared = None
+
+	_quad_indices = N.array([0,1,3,1,2,3], dtype="u4")
+
+	# the instance shared by everything that draws quads
+	@classmethod
+	def getShared(cls):
+		if cls._shared is None:
+			cls._shared = cls()
+		return cls._shared
+
+
+	def __init__(self, total_quads = 1024, usage = GL_STATIC_DRAW):
+		self._total_quads = total_quads
+		super(QuadIndexVbo,self).__init__(self._buildIndices(total_quads), usage)
+
+
+	def _buildIndices(self, total_quads):
+		dtype = "u2" if total_quads * 4 <= 65536 else "u4"
+		first = N.arange(0, total_quads * 4, 4, dtype="u4")
+		return (first[:,None] + self._quad_indices).ravel().astype(dtype)
+
+
+	def getTotalQuads(self):
+		return self._total_quads
+
+
+	# makes sure at least total_quads can be drawn
+	def reserve(self, total_quads):
+		if total_quads <= self._total_quads:
+			return
+
+		self._total_quads = max(total_quads, self._total_quads * 2)
+
+		self._setIndices(self._buildIndices(self._total_quads))
+
+
 
 # an ENTITY is a triangle, a quad a line, a tri-strip, etc..
 # a RECORD is a group of items that belong to a single vertex. A row in the data array
@@ -118,14 +426,36 @@ class DataVbo(Vbo):
 	class Error(ValueError):
 		pass
 
-	def __init__(self, data, usage = GL_STATIC_DRAW):
+	# when a flush finds at least this fraction of the records dirty, everything is
+	# uploaded with a single call
+	full_upload_ratio = 0.5
+
+	# wraps buf (see bufferAsArray) as records of items_per_record items without
+	# copying it or looking at its values
+	@classmethod
+	def fromBuffer(cls, buf, dtype, items_per_record, usage = GL_STATIC_DRAW, stream=None, ring_size=3):
+		data = bufferAsArray(buf, dtype)
+
+		if data.size % items_per_record:
+			raise cls.Error("Buffer of %s items can't hold records of %s items"%(data.size, items_per_record))
+
+		return cls(data.reshape(-1, items_per_record), usage, stream, ring_size)
+
+
+	# data can also be a structured numpy array (see layout.VertexLayout), with
+	# a record per row. It's then uploaded as raw bytes, and its fields get their
+	# offsets from the array's dtype
+	def __init__(self, data, usage = GL_STATIC_DRAW, stream=None, ring_size=3):
 		if callable(data):
 			data = data()
 
-		if isNumpyArray(data):
-			self._data = data
-		else:
-			data = self._data = toNumpyArray(data, NumpyDefaultFloatType)
+		if not isNumpyArray(data):
+			data = toNumpyArray(data, NumpyDefaultFloatType)
+
+		self._record_dtype = None
+		if data.dtype.names:
+			self._record_dtype = data.dtype
+			data = N.ascontiguousarray(data).reshape(-1).view(N.uint8).reshape(-1, data.dtype.itemsize)
 	
 		shape = data.shape
 
@@ -146,52 +476,153 @@ class DataVbo(Vbo):
 								self._total_records * self._items_per_record,
 								data.dtype,
 								usage,
-								data)
+								data,
+								stream,
+								ring_size)
+
+
+		# dirty records, as sorted, disjoint and non adjacent [start, end) ranges
+		self._dirty_starts = []
+		self._dirty_ends = []
 
+		# incremented on every change of the records, see getDataVersion
+		self._data_version = 0
 
 		self._fields = []
 		self._fields_by_name = {}
 
+		# structured data is stored as bytes: the fields take their type from the dtype
+		if self._record_dtype is None:
+			self._default_field_type = attribTypeName(self._numpy_type)
+		else:
+			self._default_field_type = None
+
 		self._total_fields_size = 0
 		self._total_fields_per_record = 0
 
 
 	# field_info is a list of tuples: ("field name", #items in field)
 	# eg. defineFiled(("normal",3),("position,3),("tc",2))
+	# optionally followed by the type of the field (see gltypes.AttribTypes), whether
+	# integer values are normalized to [0..1] or [-1..1], and the offset in bytes of the
+	# field in the record: eg. ("normal",3,"int16",True). The type defaults to that of
+	# the data, and the offset to the end of the previous field. For structured data,
+	# both default to those of the field with the same name, and the type is required
+	# for the fields not in the dtype
 	def defineFields(self, *field_info):
 		
 		offset = 0
-		for f_name, f_size in field_info:
+		for info in field_info:
+			f_name, f_size = info[0], info[1]
+			f_type = info[2] if len(info) > 2 else self._defaultFieldType(f_name)
+			normalized = bool(info[3]) if len(info) > 3 else False
+
+			if len(info) > 4:
+				offset = info[4]
+			elif self._record_dtype is not None and f_name in self._record_dtype.fields:
+				offset = self._record_dtype.fields[f_name][1]
 
-			if offset+f_size > self._items_per_record:
-				raise self.Error("Record size of %s exceeded at field '%s'"%(self._items_per_record, f_name))
+			if f_type not in AttribTypes:
+				raise self.Error("Type %s of field '%s' is not one of: %s"%(f_type, f_name, AttribTypes.keys()))
 
 			if f_size < 1 or f_size > 4:
-				raise self.Error("Field size %s for field '%s' is not in the range [1..4]"%(size, f_name))
+				raise self.Error("Field size %s for field '%s' is not in the range [1..4]"%(f_size, f_name))
+
+			f_bytes = attribBytes(f_size, f_type)
+
+			if offset+f_bytes > self._bytes_per_record:
+				raise self.Error("Record size of %s bytes exceeded at field '%s'"%(self._bytes_per_record, f_name))
 
 			self._fields_by_name[f_name] = len(self._fields)
-			# offset and f_size are in ITEMs (not bytes!)
-			self._fields.append((offset, f_size, f_name))
+			# offset is in bytes, f_size in components
+			self._fields.append((offset, f_size, f_name, f_type, normalized))
+
+			offset += f_bytes
+
+		# the VAOs built with the old fields are no longer valid
+		invalidateAll(self)
+
+
+	def _defaultFieldType(self, f_name):
+		if self._record_dtype is None:
+			return self._default_field_type
+
+		if f_name not in self._record_dtype.fields:
+			raise self.Error("Field '%s' is not in the dtype of the data, its type must be given"%f_name)
+
+		return attribTypeName(self._record_dtype.fields[f_name][0].base)
 
-			offset += f_size
+
+	# returns the fields as (name, size, type, normalized, offset) tuples, which can
+	# be passed to defineFields
+	def getFields(self):
+		return [(f_name, f_size, f_type, normalized, f_offset) for f_offset, f_size, f_name, f_type, normalized in self._fields]
+
+
+	def hasField(self, field_name):
+		return field_name in self._fields_by_name
+
+
+	def getTotalRecords(self):
+		return self._total_records
+
+
+	# the data as a structured array, if the DataVbo was created from one
+	def getRecords(self):
+		if self._record_dtype is None:
+			return None
+		return self._data.view(self._record_dtype).reshape(-1)
 
 
 
 	def setupShaderAttributes(self, shader):
 		self.bind()
-		for f_offset, f_size, f_name in self._fields:
+		for f_offset, f_size, f_name, f_type, normalized in self._fields:
+
+			loc = shader.getAttribPos(f_name)
+
+			if loc<0:
+				continue
+
+			t = AttribTypes[f_type]
+
+			glEnableVertexAttribArray(loc)
+			glVertexAttribPointer(loc, 4 if t.packed else f_size, t.gl_type, GL_TRUE if normalized else GL_FALSE, self._bytes_per_record, ctypes.c_void_p(f_offset))
+
+			#print "Attrib %s, ofs: byte %s, size: %s elements, loc: %s, type: %s, record size: %s bytes"%(f_name, f_offset, f_size, loc, t.gl_type, self._bytes_per_record)
+
+
+	# like setupShaderAttributes, but only sets the formats of the attributes of a VAO
+	# and binds them to the vertex buffer binding point, so the same VAO can be used
+	# with any DataVbo with the same fields (see bindVertexBuffer)
+	def setupShaderAttributeFormats(self, shader, binding=0):
+		for f_offset, f_size, f_name, f_type, normalized in self._fields:
 
 			loc = shader.getAttribPos(f_name)
 
 			if loc<0:
 				continue
 
-			byte_offset = f_offset * self._bytes_per_item
+			t = AttribTypes[f_type]
 
 			glEnableVertexAttribArray(loc)
-			glVertexAttribPointer(loc, f_size, self._gl_type, GL_FALSE, self._bytes_per_record, ctypes.c_void_p(byte_offset))
+			glVertexAttribFormat(loc, 4 if t.packed else f_size, t.gl_type, GL_TRUE if normalized else GL_FALSE, f_offset)
+			glVertexAttribBinding(loc, binding)
+
+
+	# binds this buffer to the vertex buffer binding point of the current VAO
+	def bindVertexBuffer(self, binding=0):
+		glBindVertexBuffer(binding, self._vbo, 0, self._bytes_per_record)
+
+
+	# used to compare how compatible two VAOs set up with setupShaderAttributeFormats
+	# are. Unlike getShaderAttributesInfo it doesn't depend on the VBO
+	def getShaderAttributesFormat(self, shader):
+		info = [self._bytes_per_record]
+		for f_offset, f_size, f_name, f_type, normalized in self._fields:
+			info.append((shader.getAttribPos(f_name), f_size, f_type, normalized, f_offset))
 
-			#print "Attrib %s, ofs: byte %s, size: %s elements, loc: %s, type: %s, record size: %s bytes"%(f_name, byte_offset, f_size, loc, self._gl_type, self._bytes_per_record)
+		return tuple(info)
 
 
 	# used to compare how compatible two VAOs are
@@ -199,7 +630,7 @@ class DataVbo(Vbo):
 		# first the self id (a VAO implicitly binds a data VBO)
 		# two VAOs are not equivalent if they don't point to the same VBO
 		info = [id(self)]
-		for f_offset, f_size, f_name in self._fields:
+		for f_offset, f_size, f_name, f_type, normalized in self._fields:
 			loc = shader.getAttribPos(f_name)
 			# the VertexAttribPointer's must bind the same locations for each field
 			info.append(loc)
@@ -207,9 +638,68 @@ class DataVbo(Vbo):
 		return tuple(info)
 
 
-	def getSlice(self, field_name, from_record=0, to_record=-1):
-		f = self._fields[self._fields_by_name[field_name]]
-		return self._data[from_record, to_record, f[0]:f[0]+f[1]]
+	# the host copy of the data (a view of the mapped memory with STREAM_PERSISTENT)
+	@property
+	def _data(self):
+		return self._buffer
+
+
+	# first record of the data of the current frame, for the ring streaming modes.
+	# To be used as base vertex when drawing
+	def getBaseRecord(self):
+		return self._segment * self._total_records
+
+
+	# returns a view of the values of a field, as (records, items) array. For packed
+	# fields there's a single item per record
+	def getSlice(self, field_name, from_record=0, to_record=None):
+		f_offset, f_size, f_name, f_type, normalized = self._fields[self._fields_by_name[field_name]]
+
+		rows = self._data.reshape(self._total_records, -1)[from_record:to_record]
+		t = N.dtype(AttribTypes[f_type].numpy_type)
+
+		return N.ndarray(
+					shape = (rows.shape[0], attribBytes(f_size, f_type) // t.itemsize),
+					dtype = t,
+					buffer = rows,
+					offset = f_offset,
+					strides = (self._bytes_per_record, t.itemsize))
+
+
+	# changes whenever the records are modified through markDirty, updateData or
+	# remapRecords, so that what's derived from them (eg. the bounds of an ObjManager)
+	# can be checked lazily
+	def getDataVersion(self):
+		return self._data_version
+
+
+	# moves record r to remap[r] (see IndexVbo.optimize)
+	def remapRecords(self, remap):
+		if len(remap) != self._total_records:
+			raise self.Error("Remap of %s records for %s records"%(len(remap), self._total_records))
+
+		self._data[...] = remapVertices(self._data.reshape(self._total_records, -1), remap).reshape(self._data.shape)
+		self.markDirty()
+
+
+	# copies records from another DataVbo (or this one) both in the host copy and
+	# in the GPU, without going through the host. Ranges must not overlap
+	def copyRecords(self, src_vbo, src_record, dst_record, total_records):
+		self._data[dst_record:dst_record+total_records] = src_vbo._data[src_record:src_record+total_records]
+
+		# the host copy is the GPU copy with STREAM_PERSISTENT
+		if self._stream in (self.STREAM_ORPHAN, self.STREAM_RING, self.STREAM_PERSISTENT):
+			self.markDirty(dst_record, dst_record+total_records)
+			return
+
+		src_vbo.flush() # the source range may not have been uploaded yet
+
+		bpr = self._bytes_per_record
+		glBindBuffer(GL_COPY_READ_BUFFER, src_vbo._vbo)
+		glBindBuffer(GL_COPY_WRITE_BUFFER, self._vbo)
+		glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, (src_record + src_vbo.getBaseRecord()) * bpr, dst_record * bpr, total_records * bpr)
+		glBindBuffer(GL_COPY_READ_BUFFER, 0)
+		glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
 
 
 	def updateData(self, from_record = 0, to_record=-1):
@@ -220,11 +710,80 @@ class DataVbo(Vbo):
 		if from_record < 0:
 			from_record += self._total_records
 
+		self._data_version += 1
+
+		if self._stream == self.STREAM_PERSISTENT: # coherent mapping: already visible
+			self._markWritten(from_record, min(to_record + 1, self._total_records))
+			return
+
+		self.bind()
+		self._uploadRange(from_record, to_record)
 
-		offset = from_record * self._bytes_per_record
-		size = (to_record - from_record) * self._bytes_per_record
+
+	# flags records as modified, to be uploaded by the next flush(). Overlapping and
+	# adjacent ranges are merged. to_record is exclusive; None means up to the end
+	def markDirty(self, from_record = 0, to_record = None):
+		if to_record is None:
+			to_record = self._total_records
+		elif to_record < 0:
+			to_record += self._total_records
+
+		if from_record < 0:
+			from_record += self._total_records
+
+		if from_record >= to_record:
+			return
+
+		self._data_version += 1
+
+		if self._stream == self.STREAM_PERSISTENT:
+			self._markWritten(from_record, to_record)
+
+		_addRange(self._dirty_starts, self._dirty_ends, from_record, to_record)
+
+
+	def isDirty(self):
+		return bool(self._dirty_starts)
+
+
+	# uploads all the dirty records, binding the buffer only once. Falls back to a
+	# single upload of everything when most of the buffer is dirty
+	def flush(self):
+		if not self._dirty_starts:
+			return
+
+		ranges = zip(self._dirty_starts, self._dirty_ends)
+		self._dirty_starts = []
+		self._dirty_ends = []
+
+		if self._stream == self.STREAM_PERSISTENT:
+			return
+
+		dirty = sum(end - start for start, end in ranges)
+		if self._stream == self.STREAM_ORPHAN or dirty >= self.full_upload_ratio * self._total_records:
+			ranges = [(0, self._total_records)]
 
 		self.bind()
+		for start, end in ranges:
+			self._uploadRange(start, end)
+
+
+	# uploads records [from_record, to_record). The buffer must be bound
+	def _uploadRange(self, from_record, to_record):
+		if self._stream == self.STREAM_ORPHAN:
+			glBufferData(GL_ARRAY_BUFFER, self._allocated_bytes, self._data.ravel().ctypes.data_as(ctypes.c_void_p), self._usage)
+			return
+
+		if self._stream == self.STREAM_RING and self._segment_frame != Vbo._frame:
+			# first update of the frame: everything goes to the next segment
+			self._segment = (self._segment + 1) % self._ring_size
+			self._segment_frame = Vbo._frame
+			from_record = 0
+			to_record = self._total_records
+
+		offset = (from_record + self.getBaseRecord()) * self._bytes_per_record
+		size = (to_record - from_record) * self._bytes_per_record
+
 		glBufferSubData(GL_ARRAY_BUFFER, offset, size, self._data[from_record:].ravel().ctypes.data_as(ctypes.c_void_p))
 
 
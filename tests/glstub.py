@@ -0,0 +1,91 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+# A stand-in for glcompat that records the GL calls instead of making them, so the
+# tests run without an OpenGL context. install() must be called before the sPyGlass
+# modules are imported: they are then imported as top level modules, like they
+# import each other
+
+import ctypes
+import os
+import re
+import sys
+import types
+
+
+calls = [] # (name, args) of every GL function called
+
+_package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sPyGlass")
+
+
+def _recorder(name):
+	# the module globals are gone when the last objects die, at exit
+	log = calls
+
+	def call(*args):
+		log.append((name, args))
+		return 1
+	return call
+
+
+# the names of the GL functions and constants used by the package
+def _glNames():
+	names = set()
+	for filename in os.listdir(_package_dir):
+		if filename.endswith(".py"):
+			with open(os.path.join(_package_dir, filename)) as f:
+				names.update(re.findall(r"\b(gl[A-Z]\w*|GL_\w+)\b", f.read()))
+	return sorted(names)
+
+
+def install():
+	if "glcompat" in sys.modules:
+		return
+
+	module = types.ModuleType("glcompat")
+
+	for i, name in enumerate(_glNames()):
+		setattr(module, name, _recorder(name) if name.startswith("gl") else 0x8000 + i)
+
+	module.GL_FALSE = 0
+	module.GL_TRUE = 1
+
+	for name in ("GLbyte", "GLubyte", "GLshort", "GLushort", "GLint", "GLuint", "GLfloat", "GLdouble"):
+		setattr(module, name, getattr(ctypes, "c_" + name[2:]))
+
+	module.ctypes = ctypes
+
+	sys.modules["glcompat"] = module
+	sys.path.insert(0, _package_dir)
+
+
+# the names of the calls recorded since the last clear() that start with prefix
+def callNames(prefix="gl"):
+	return [name for name, args in calls if name.startswith(prefix)]
+
+
+def clear():
+	del calls[:]
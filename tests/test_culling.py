@@ -0,0 +1,94 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import unittest
+
+import glstub
+glstub.install()
+
+import numpy as N
+from objmanager import ObjManager
+
+
+class Scene(object):
+	def __init__(self):
+		self._modelview = [N.eye(4)]
+		self._modelview[0][2,3] = -20.0
+
+	def getProjectionMatrix(self):
+		f = 1.0 / N.tan(N.radians(30.0))
+		p = N.zeros((4, 4))
+		p[0,0] = p[1,1] = f
+		p[2,2], p[2,3], p[3,2] = -1.01, -0.2, -1.0
+		return p
+
+	def getModelViewMatrix(self):
+		return self._modelview[-1]
+
+	def pushTransform(self, transform):
+		self._modelview.append(N.dot(self._modelview[-1], transform))
+
+	def popTransform(self):
+		self._modelview.pop()
+
+
+class CullObjectsTest(unittest.TestCase):
+
+	def testSameAsIsVisible(self):
+		N.random.seed(1)
+		scene = Scene()
+
+		managers = []
+		for i in xrange(200):
+			m = ObjManager(None, None)
+			m.setBoundingSphere(N.random.randn(3) * 20.0, abs(N.random.randn()) * 2.0)
+			if i % 2:
+				t = N.eye(4)
+				t[:3,3] = N.random.randn(3) * 10.0
+				t[:3,:3] *= N.random.rand() + 0.5
+				m.setTransform(t)
+			managers.append(m)
+
+		expected = []
+		for m in managers:
+			if m.getTransform() is not None:
+				scene.pushTransform(m.getTransform())
+			if m.isVisible(scene):
+				expected.append(m)
+			if m.getTransform() is not None:
+				scene.popTransform()
+
+		self.assertTrue(0 < len(expected) < len(managers))
+		self.assertEqual(ObjManager.cullObjects(scene, managers), expected)
+
+
+	def testWithoutBoundsAlwaysVisible(self):
+		m = ObjManager(None, None)
+		self.assertEqual(ObjManager.cullObjects(Scene(), [m]), [m])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,91 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import unittest
+
+import glstub
+glstub.install()
+
+import numpy as N
+from bvh import BoundingVolumeTree
+from hierarchy import TransformHierarchy
+
+
+class Bounded(object):
+	def getBoundingBox(self):
+		return N.array([-1.0, -1.0]), N.array([1.0, 1.0])
+
+
+class TreeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.hierarchy = TransformHierarchy()
+		self.tree = BoundingVolumeTree()
+
+		self.parent = self.hierarchy.add(translation=(10.0, 0.0, 0.0))
+		self.child = self.hierarchy.add(self.parent, translation=(0.0, 5.0, 0.0))
+		self.other = self.hierarchy.add(translation=(-10.0, 0.0, 0.0))
+
+		self.obj = Bounded()
+		self.proxy = self.hierarchy.addToTree(self.tree, self.child, self.obj)
+		self.other_proxy = self.hierarchy.addToTree(self.tree, self.other, Bounded())
+
+	def found(self, lo, hi):
+		return list(self.tree.queryBox(N.array(lo), N.array(hi)))
+
+	def testInsertedInWorldSpace(self):
+		self.assertEqual(self.found([9.5, 4.5, -0.5], [10.5, 5.5, 0.5]), [self.obj])
+		self.assertEqual(self.found([-0.5, -0.5, -0.5], [0.5, 0.5, 0.5]), [])
+
+	def testFollowsParent(self):
+		other_bounds = self.tree.getBounds(self.other_proxy)
+
+		self.hierarchy.setLocal(self.parent, translation=(100.0, 0.0, 0.0))
+		self.hierarchy.update()
+
+		self.assertEqual(self.found([9.5, 4.5, -0.5], [10.5, 5.5, 0.5]), [])
+		self.assertEqual(self.found([99.5, 4.5, -0.5], [100.5, 5.5, 0.5]), [self.obj])
+
+		# the objects of unchanged nodes aren't moved
+		lo, hi = self.tree.getBounds(self.other_proxy)
+		self.assertTrue(N.array_equal(lo, other_bounds[0]) and N.array_equal(hi, other_bounds[1]))
+
+	def testScaledBounds(self):
+		self.hierarchy.setLocal(self.child, scale=(4.0, 1.0, 1.0))
+		self.hierarchy.update()
+
+		self.assertEqual(self.found([13.5, 4.5, -0.5], [13.9, 5.5, 0.5]), [self.obj])
+
+	def testRemoved(self):
+		self.hierarchy.removeFromTree(self.tree, self.proxy)
+		self.hierarchy.setLocal(self.parent, translation=(100.0, 0.0, 0.0))
+		self.hierarchy.update()
+
+		self.assertEqual(self.found([-200.0, -200.0, -200.0], [200.0, 200.0, 200.0]), [self.tree.getObject(self.other_proxy)])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,129 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import unittest
+
+import glstub
+glstub.install()
+
+from mem import MemoryManager
+
+
+class Manager(MemoryManager):
+	page_size = 16
+
+	def __init__(self, deferred_free):
+		super(Manager, self).__init__(deferred_free=deferred_free)
+		self.signaled = set()
+		self.waited = []
+
+	def _allocNewPage(self, min_size):
+		return [None] * max(min_size, self.page_size), max(min_size, self.page_size)
+
+	def _moveData(self, src_page, src_start, dst_page, dst_start, size):
+		self._pages[dst_page][dst_start:dst_start+size] = self._pages[src_page][src_start:src_start+size]
+
+	def _pageSizeFor(self, min_size):
+		return max(min_size, self.page_size)
+
+	# the fences only signal when waited on
+	def _insertFence(self):
+		return object()
+
+	def _isFenceSignaled(self, fence):
+		return fence in self.signaled
+
+	def _waitFence(self, fence):
+		self.waited.append(fence)
+		self.signaled.add(fence)
+
+
+class MemoryLimitTest(unittest.TestCase):
+
+	def fill(self, deferred_free):
+		mem = Manager(deferred_free)
+		blocks = [mem.alloc(16), mem.alloc(16)]
+
+		def evict(manager, size):
+			if not blocks:
+				return False
+			blocks.pop(0).free()
+			return True
+
+		mem.setMemoryLimit(32, evict)
+		return mem, blocks
+
+	def testEvictWithDeferredFree(self):
+		mem, blocks = self.fill(True)
+
+		mem.alloc(16)
+		self.assertEqual(len(blocks), 1)
+		self.assertEqual(len(mem.waited), 1)
+
+		stats = mem.stats()
+		self.assertEqual((stats.page_allocs, stats.retired_bytes), (2, 0))
+
+	def testEvictWithoutDeferredFree(self):
+		mem, blocks = self.fill(False)
+
+		mem.alloc(16)
+		self.assertEqual(len(blocks), 1)
+		self.assertEqual(mem.waited, [])
+		self.assertEqual(mem.stats().page_allocs, 2)
+
+	def testNothingToEvict(self):
+		mem, blocks = self.fill(True)
+
+		mem.alloc(16)
+		mem.alloc(16)
+		self.assertRaises(MemoryError, mem.alloc, 16)
+
+
+class CompactTest(unittest.TestCase):
+
+	def testMovedIntoLowerHole(self):
+		mem = Manager(False)
+		blocks = [mem.alloc(4) for i in xrange(4)]
+		blocks[-1].page_data[12:16] = "abcd"
+
+		blocks[0].free()
+		blocks[1].free()
+		self.assertTrue(mem.compact())
+
+		# the last block goes to the best fitting hole below it
+		self.assertEqual(blocks[-1].start, 0)
+		self.assertEqual(blocks[-1].page_data[0:4], list("abcd"))
+
+	def testNoHoleBelow(self):
+		mem = Manager(False)
+		blocks = [mem.alloc(4) for i in xrange(3)]
+
+		self.assertTrue(mem.compact())
+		self.assertEqual([b.start for b in blocks], [0, 4, 8])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,109 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import unittest
+
+import glstub
+glstub.install()
+
+import numpy as N
+from vbo import DataVbo, IndexVbo
+from objmanager import ObjManager
+
+
+class Shader(object):
+	def use(self):
+		pass
+
+	def getAttribPos(self, name):
+		return 0 if name == "position" else -1
+
+	def hasAttrib(self, name):
+		return name == "position"
+
+
+class Material(object):
+	def toCompiled(self, shader):
+		return lambda: None
+
+
+class Scene(object):
+	def pushTransform(self, transform=None):
+		pass
+
+	def popTransform(self):
+		pass
+
+	def uploadUniforms(self, shader):
+		pass
+
+
+class MultiDrawTest(unittest.TestCase):
+
+	def setUp(self):
+		data = DataVbo(N.zeros((4, 3), dtype=N.float32))
+		data.defineFields(("position", 3))
+		indices = IndexVbo([0, 1, 2, 0, 2, 3])
+
+		self.obj = ObjManager(data, indices)
+		shader, material = Shader(), Material()
+		self.obj.addBatch(shader, material, 0, 1)
+		self.obj.addBatch(shader, material, 3, 1)
+
+		self.scene = Scene()
+
+
+	def tearDown(self):
+		ObjManager.setMultiDraw(None)
+
+
+	def drawCalls(self):
+		glstub.clear()
+		self.obj.draw(self.scene)
+		return [name for name in glstub.callNames() if name.startswith("glDraw") or name.startswith("glMultiDraw")]
+
+
+	def testSingleCallPerGroup(self):
+		ObjManager.setMultiDraw(ObjManager.MULTI_DRAW)
+		self.assertEqual(self.drawCalls(), ["glMultiDrawElements"])
+
+
+	def testSwitchModesBetweenDraws(self):
+		ObjManager.setMultiDraw(ObjManager.MULTI_DRAW_INDIRECT)
+		self.assertEqual(self.drawCalls(), ["glMultiDrawElementsIndirect"])
+
+		ObjManager.setMultiDraw(ObjManager.MULTI_DRAW)
+		self.assertEqual(self.drawCalls(), ["glMultiDrawElements"])
+
+		ObjManager.setMultiDraw(ObjManager.MULTI_DRAW_INDIRECT)
+		self.assertEqual(self.drawCalls(), ["glMultiDrawElementsIndirect"])
+
+		ObjManager.setMultiDraw(None)
+		self.assertEqual(self.drawCalls(), ["glDrawElements", "glDrawElements"])
+
+
+if __name__ == "__main__":
+	unittest.main()
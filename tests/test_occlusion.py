@@ -0,0 +1,113 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import itertools
+import unittest
+
+import glstub
+glstub.install()
+
+import numpy as N
+import occlusion
+from bvh import BoundingVolumeTree
+
+
+class Shader(object):
+	uni_projection_m = uni_modelview_m = uni_box_lo = uni_box_hi = 0
+
+	def use(self):
+		pass
+
+	def getAttribPos(self, name):
+		return 0
+
+
+class Scene(object):
+	def getModelViewMatrix(self):
+		m = N.eye(4)
+		m[2,3] = -50.0
+		return m
+
+	def getProjectionMatrix(self):
+		p = N.zeros((4, 4))
+		p[0,0] = p[1,1] = 1.0
+		p[2,2], p[2,3], p[3,2] = -1.001, -0.2, -1.0
+		return p
+
+
+# the objects are numbers. Those below 8 are hidden (behind something)
+class DrawTreeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.results = {} # query -> samples passed
+		self.ids = itertools.count(1)
+
+		occlusion.glGenQueries = lambda n: next(self.ids)
+		occlusion.glGetQueryObjectuiv = lambda query, pname: 1 if pname == occlusion.GL_QUERY_RESULT_AVAILABLE else self.results.get(query, 1)
+
+		self.tree = BoundingVolumeTree()
+		self.proxies = [self.tree.insert(i, [i-8, 0, 0], [i-7.5, 1, 1]) for i in xrange(16)]
+
+		self.culler = occlusion.OcclusionCuller(shader=Shader())
+		self.scene = Scene()
+
+
+	def frame(self):
+		culler, tree = self.culler, self.tree
+
+		culler.beginFrame()
+		drawn = []
+		culler.drawTree(self.scene, tree, drawn.append)
+		culler.flush(self.scene)
+
+		for (t, node, stamp), query in culler._pending.items():
+			lo, hi = tree.getBounds(node)
+			hidden = tree.getObject(node) < 8 if tree.isLeaf(node) else hi[0] <= 0.2
+			self.results[query] = 0 if hidden else 1
+
+		return sorted(drawn)
+
+
+	def testHiddenSubtreeSkipped(self):
+		self.assertEqual(self.frame(), range(16))
+		self.assertEqual(self.frame(), range(8, 16))
+		self.assertEqual(self.frame(), range(8, 16))
+
+
+	# a visible object moving out of its enlarged box is reinserted, which must not
+	# reset the state of the hidden part of the tree
+	def testMovingObjectKeepsOthersCulled(self):
+		for i in xrange(3):
+			self.frame()
+
+		for step in xrange(5):
+			x = 8.0 + step
+			self.assertTrue(self.tree.move(self.proxies[15], [x, 0, 0], [x + 0.5, 1, 1]))
+			self.assertEqual(self.frame(), range(8, 16))
+
+
+if __name__ == "__main__":
+	unittest.main()
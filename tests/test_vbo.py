@@ -0,0 +1,82 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import ctypes
+import unittest
+
+import glstub
+glstub.install()
+
+import numpy as N
+import vbo
+from vbo import Vbo, DataVbo
+
+
+class PersistentStreamTest(unittest.TestCase):
+
+	def setUp(self):
+		self.memory = (ctypes.c_ubyte * (10 * 4 * 4 * 3))()
+		vbo.glMapBufferRange = lambda *args: ctypes.addressof(self.memory)
+		vbo.glClientWaitSync = lambda *args: vbo.GL_ALREADY_SIGNALED
+
+		self.data = DataVbo(N.zeros((10, 4), dtype=N.float32), vbo.GL_DYNAMIC_DRAW, Vbo.STREAM_PERSISTENT)
+		glstub.clear()
+
+
+	def testWrittenRowsCarriedOver(self):
+		d = self.data
+		stale = d._mapped[2]
+		stale[7] = 99.0 # never written: must not be copied over
+
+		d.getBuffer()[3] = 1.0
+		d.markDirty(3, 4)
+		Vbo.endFrame()
+
+		d.getBuffer()[5] = 2.0
+		d.markDirty(5, 6)
+		Vbo.endFrame()
+
+		buf = d.getBuffer()
+		self.assertEqual(d._segment, 2)
+		self.assertTrue((buf[3] == 1.0).all() and (buf[5] == 2.0).all())
+		self.assertTrue((buf[7] == 99.0).all())
+
+		# back to the first segment, which only missed the row written in the second frame
+		Vbo.endFrame()
+		self.assertTrue((d.getBuffer()[5] == 2.0).all())
+
+
+	def testSegmentReusedAfterItsFence(self):
+		for i in xrange(4):
+			Vbo.endFrame()
+
+		self.assertEqual(len(glstub.callNames("glFenceSync")), 4)
+		# the first two segments were reused, after their fences signaled
+		self.assertEqual(len(glstub.callNames("glDeleteSync")), 2)
+
+
+if __name__ == "__main__":
+	unittest.main()